@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+
+###
+##  End-to-end benchmark of the explore path against the local stand-in distribution point
+##
+##  Every round requests the boot files from FakeDistributionPoint, downloads the media from the TFTP
+##  stand-in and decrypts it, then checks the result against the synthetic media. The explore mode goes
+##  through loot_ip_address and the DHCP engine, the socket mode does the DHCP exchange over a throwaway
+##  UDP socket of its own as a baseline.
+##
+##  python3 bench/bench_explore.py --sizes 4096,65536,1048576 --rounds 5
+###
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pxelog
+import pxekeys
+import pxemedia
+import pxenet
+import pxethiefy
+from pxeharness import DistributionPointHarness, socket_request
+
+def explore_once(harness, mode):
+    # Returns the DPResult of one explore round and its wall time
+    start = time.perf_counter()
+    if mode == "explore":
+        result = pxethiefy.loot_ip_address(harness.dp.host)[0]
+    else:
+        result = pxethiefy.DPResult(harness.dp.host)
+        with pxethiefy.phase_timer(result, "dhcp_request"):
+            dhcp_options = socket_request(harness.dp.host, harness.dp.port)
+            result.option_243 = dhcp_options[243]
+            result.variables_file, result.bcd_file, result.encrypted_key = pxenet.extract_boot_files(result.option_243, list(dhcp_options.items()))
+        pxethiefy.loot_boot_files(harness.dp.host, result.variables_file, result.bcd_file, result.encrypted_key, result)
+    return result, time.perf_counter() - start
+
+def check_result(harness, result, blank):
+    if result.error or result.variables_file != harness.variables_file or result.bcd_file != harness.bcd_file:
+        return f"unexpected boot files: {result}"
+    if blank:
+        expected = {name: harness.media_variables[name] for name in pxemedia.MEDIA_VARIABLES}
+        if not result.decrypted or result.media_variables != expected:
+            return "blank password media was not decrypted"
+    elif result.hashcat_hash != f"$sccm$aes128${harness.media[:pxemedia.MEDIA_FILE_HEADER_SIZE].hex()}":
+        return "wrong hash for password protected media"
+    return None
+
+def bench_decrypt(harness, directory, rounds):
+    # Offline decryption of the whole document, best of rounds
+    path = os.path.join(directory, "bench.boot.var")
+    with open(path, "wb") as media_file:
+        media_file.write(harness.media)
+    key = pxekeys.derive_media_key(harness.password)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        media_variables, _, _ = pxemedia.decrypt_media_variables(path, key, None)
+        timings.append(time.perf_counter() - start)
+        assert media_variables == harness.media_variables
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark explore against a local stand-in distribution point")
+    parser.add_argument("--sizes", default="4096,65536,1048576,4194304", help="Comma separated media sizes, in characters of XML")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds per size, the best one is reported")
+    parser.add_argument("--mode", choices=("explore", "socket"), default="explore", help="How the DHCP request is sent")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay added to every packet the stand-ins send, in seconds")
+    parser.add_argument("--verbose", action="store_true", help="Show the pxethiefy output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        pxelog.gLogStream = open(os.devnull, "w")
+    pxethiefy.gSaveMediaFiles = False
+    pxenet.gReplyTimeout = 2
+    failures = 0
+    print(f"mode {args.mode}, latency {args.latency*1000:.1f} ms, best of {args.rounds}")
+    print(f"{'media':>12} {'key':>8} {'explore':>11} {'dhcp':>10} {'tftp':>12} {'decrypt':>12}")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # The BCD file is always written to the working directory
+        os.chdir(directory)
+        for size in (int(size) for size in args.sizes.split(",")):
+            for blank in (True, False):
+                with DistributionPointHarness(size, blank=blank, latency=args.latency) as harness:
+                    pxethiefy.gTftpOptions["port"] = harness.tftp.port
+                    best = None
+                    for _ in range(args.rounds):
+                        result, elapsed = explore_once(harness, args.mode)
+                        error = check_result(harness, result, blank)
+                        if error:
+                            print(f"FAIL: {len(harness.media)} byte {'blank' if blank else 'password'} media: {error}")
+                            failures += 1
+                            break
+                        if best is None or elapsed < best[1]:
+                            best = (result, elapsed)
+                    if best is None:
+                        continue
+                    result, elapsed = best
+                    megabytes = len(harness.media) / 1024 / 1024
+                    tftp = f"{megabytes / result.timings['tftp_download']:7.2f} MB/s"
+                    decrypt = f"{megabytes / bench_decrypt(harness, directory, args.rounds):7.2f} MB/s"
+                    print(f"{len(harness.media):>12} {'blank' if blank else 'password':>8} {elapsed*1000:8.1f} ms "
+                          f"{result.timings['dhcp_request']*1000:7.2f} ms {tftp:>12} {decrypt:>12}")
+        os.chdir(cwd)
+    if failures:
+        print(f"{failures} checks failed")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+
+###
+##  Micro-benchmarks for pxekeys against the original per-byte key derivation
+##
+##  python3 bench/bench_keys.py --batch 100000
+###
+
+import os
+import sys
+import struct
+import timeit
+import argparse
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Crypto.Cipher import AES
+import pxekeys
+
+## Original implementations, kept here as the baseline
+def legacy_aes_des_key_derivation(password):
+    key_sha1 = sha1(password).digest()
+    b0 = b""
+    for x in key_sha1:
+        b0 += bytes((x ^ 0x36,))
+    b1 = b""
+    for x in key_sha1:
+        b1 += bytes((x ^ 0x5c,))
+    b0 += b"\x36"*(64 - len(b0))
+    b1 += b"\x5c"*(64 - len(b1))
+    return sha1(b0).digest() + sha1(b1).digest()
+
+def legacy_derive_blank_decryption_key(encrypted_key):
+    length = encrypted_key[0]
+    encrypted_bytes = encrypted_key[1:1+length][20:-12]
+    key = legacy_aes_des_key_derivation(pxekeys.BLANK_PASSWORD_KEY_DATA)
+    var_file_key = AES.new(key[:16], AES.MODE_CBC, b"\x00"*16).decrypt(encrypted_bytes[:16])[:10]
+    new_key = bytearray()
+    for byte in struct.unpack('10c', var_file_key):
+        if (0x80 & byte[0]) == 128:
+            new_key = new_key + byte + b'\xFF'
+        else:
+            new_key = new_key + byte + b'\x00'
+    return new_key
+
+def legacy_derive_media_keys(passwords):
+    return [legacy_aes_des_key_derivation(password.encode("utf-16-le"))[:16] for password in passwords]
+
+def report(name, legacy, current, number):
+    legacy_time = min(timeit.repeat(legacy, number=number, repeat=3)) / number
+    current_time = min(timeit.repeat(current, number=number, repeat=3)) / number
+    print(f"{name:<32} {legacy_time*1e6:10.2f} us {current_time*1e6:10.2f} us {legacy_time/current_time:7.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare pxekeys with the original key derivation")
+    parser.add_argument("--batch", type=int, default=10000, help="Number of passwords in the batch benchmark")
+    args = parser.parse_args()
+
+    passwords = [f"Password{i}!" for i in range(args.batch)]
+    encrypted_key = bytes([48]) + os.urandom(48)
+    password = passwords[0].encode("utf-16-le")
+
+    # Both implementations have to agree before their speed matters
+    assert pxekeys.aes_des_key_derivation(password) == legacy_aes_des_key_derivation(password)
+    assert pxekeys.derive_blank_decryption_key(encrypted_key) == legacy_derive_blank_decryption_key(encrypted_key)
+    assert pxekeys.derive_media_keys(passwords[:100]) == legacy_derive_media_keys(passwords[:100])
+
+    print(f"{'':<32} {'original':>13} {'pxekeys':>13} {'speedup':>8}")
+    report("aes_des_key_derivation", lambda: legacy_aes_des_key_derivation(password), lambda: pxekeys.aes_des_key_derivation(password), 20000)
+    report("derive_blank_decryption_key", lambda: legacy_derive_blank_decryption_key(encrypted_key), lambda: pxekeys.derive_blank_decryption_key(encrypted_key), 5000)
+    report(f"derive_media_keys (batch {args.batch})", lambda: legacy_derive_media_keys(passwords), lambda: pxekeys.derive_media_keys(passwords), 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+
+###
+##  Benchmark of PXE reply extraction from a noisy packet capture
+##
+##  Writes a synthetic capture in which a few PXE replies (option 243, from udp/4011) are buried in DHCP
+##  chatter (requests, offers and ACKs without option 243), DNS, TCP and ARP. It then reads it with
+##  pxenet.read_pxe_replies, which checks every frame at the byte level first, and with a full scapy
+##  dissection of every frame as a baseline. Both must find the same replies.
+##
+##  python3 bench/bench_replies.py --packets 100000 --replies 10
+###
+
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pxestats
+import pxenet
+from scapy.all import ARP, DNS, DNSQR, IP, TCP, UDP, Ether, PcapReader, RawPcapWriter
+from pxeharness import build_dhcp_reply, build_dhcp_request, make_encrypted_key, make_option_243
+
+VARIABLES_FILE = "SMSTemp\\2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var"
+BROADCAST = "ff:ff:ff:ff:ff:ff"
+
+def make_noise():
+    # One frame of every kind of traffic a busy segment carries besides PXE replies
+    request = build_dhcp_request(random.getrandbits(32))
+    offer = build_dhcp_reply(request, "10.0.0.1", [(51, b"\x00\x01\x51\x80"), (1, socket.inet_aton("255.255.255.0"))])
+    return [
+        bytes(Ether(dst=BROADCAST)/IP(src="0.0.0.0", dst="255.255.255.255")/UDP(sport=68, dport=67)/request),
+        bytes(Ether(dst=BROADCAST)/IP(src="10.0.0.1", dst="255.255.255.255")/UDP(sport=67, dport=68)/offer),
+        bytes(Ether()/IP(src="10.0.0.20", dst="10.0.0.53")/UDP(sport=53001, dport=53)/DNS(qd=DNSQR(qname="mp.lab.local"))),
+        bytes(Ether()/IP(src="10.0.0.20", dst="10.0.0.80")/TCP(sport=50000, dport=443, flags="A")/(b"\x17" * 200)),
+        bytes(Ether(dst=BROADCAST)/ARP(pdst="10.0.0.1")),
+    ]
+
+def make_pxe_reply(server_ip):
+    encrypted_key, _ = make_encrypted_key()
+    reply = build_dhcp_reply(build_dhcp_request(random.getrandbits(32)), server_ip, [(243, make_option_243(VARIABLES_FILE, encrypted_key))])
+    return bytes(Ether()/IP(src=server_ip, dst="10.0.0.20")/UDP(sport=4011, dport=68)/reply)
+
+def write_capture(path, packets, replies):
+    noise = make_noise()
+    # Every reply comes from a server of its own
+    reply_at = {index: f"10.0.{server // 250 + 1}.{server % 250 + 1}" for server, index in enumerate(sorted(random.sample(range(packets), replies)))}
+    with RawPcapWriter(path, linktype=1) as writer:
+        for index in range(packets):
+            writer.write(make_pxe_reply(reply_at[index]) if index in reply_at else noise[index % len(noise)])
+
+def read_dissecting(path):
+    # Baseline: every frame is fully dissected by scapy before it is looked at
+    with PcapReader(path) as reader:
+        for packet in reader:
+            if UDP not in packet or IP not in packet or packet[UDP].sport not in pxenet.PXE_REPLY_PORTS:
+                continue
+            bootp_layer = pxenet.get_bootp_layer(packet)
+            if bootp_layer is None or bootp_layer.op != 2 or pxenet.DHCP not in bootp_layer:
+                continue
+            dhcp_options = bootp_layer[pxenet.DHCP].options
+            if pxenet.get_dhcp_option(dhcp_options, 243):
+                yield packet[IP].src, dhcp_options
+
+def measure(reader, path, rounds):
+    # Returns (best seconds, [(server IP, option 243)])
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        found = [(server, pxenet.get_dhcp_option(options, 243)) for server, options in reader(path)]
+        timings.append(time.perf_counter() - start)
+    return min(timings), found
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PXE reply extraction from a noisy capture")
+    parser.add_argument("--packets", type=int, default=20000, help="Frames in the synthetic capture")
+    parser.add_argument("--replies", type=int, default=10, help="PXE replies among them")
+    parser.add_argument("--rounds", type=int, default=3, help="Reads per method, the best one is reported")
+    parser.add_argument("--no-baseline", action="store_true", help="Skip the full dissection baseline, which is slow on big captures")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "noisy.pcap")
+        write_capture(path, args.packets, min(args.replies, args.packets))
+        print(f"capture: {args.packets} frames, {os.path.getsize(path) / 1024 / 1024:.1f} MB, {args.replies} PXE replies")
+        elapsed, found = measure(pxenet.read_pxe_replies, path, args.rounds)
+        stats = pxestats.snapshot()["counters"]
+        print(f"{'pre-check':>14} {elapsed * 1000:10.1f} ms {args.packets / elapsed:12.0f} frames/s  "
+              f"{stats.get('capture_packets_decoded', 0) // args.rounds} decoded by scapy per read")
+        failed = len(found) != args.replies
+        if not args.no_baseline:
+            baseline_elapsed, baseline_found = measure(read_dissecting, path, args.rounds)
+            print(f"{'full dissect':>14} {baseline_elapsed * 1000:10.1f} ms {args.packets / baseline_elapsed:12.0f} frames/s  "
+                  f"{args.packets} decoded by scapy per read")
+            print(f"speedup: {baseline_elapsed / elapsed:.1f}x")
+            failed = failed or found != baseline_found
+    if failed:
+        print(f"FAIL: found {len(found)} replies, expected {args.replies} matching the baseline")
+        return 1
+    print("OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+
+###
+##  Startup benchmark for the decrypt subcommand
+##
+##  Runs 'pxethiefy.py decrypt' on a synthetic media file under 'python -X importtime' and fails
+##  when it takes longer than the budget or when it loads the network stack.
+##
+##  python3 bench/bench_startup.py --budget 200
+###
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from pxeharness import encrypt_media_file, make_media_variables
+
+# Modules that only explore/analyze need
+FORBIDDEN_MODULES = ("scapy", "asyncio", "pxenet", "pxetftp")
+
+def make_media_file(path, password):
+    with open(path, "wb") as media_file:
+        media_file.write(encrypt_media_file(make_media_variables(), password))
+
+def run_decrypt(media_path, password):
+    # Returns (wall seconds, [(cumulative us, module)]) of a single decrypt run
+    command = [sys.executable, "-X", "importtime", os.path.join(ROOT, "pxethiefy.py"), "decrypt", "--no-cache", "-p", password, "-f", media_path]
+    start = time.perf_counter()
+    process = subprocess.run(command, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0 or "Successfully decrypted" not in process.stdout:
+        sys.exit(f"decrypt failed:\n{process.stdout}{process.stderr}")
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        imports.append((int(cumulative), module.strip()))
+    return elapsed, imports
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of 'pxethiefy.py decrypt'")
+    parser.add_argument("--budget", type=float, default=200, help="Maximum wall time of a decrypt run in milliseconds")
+    parser.add_argument("--rounds", type=int, default=5, help="Runs to make, the best one is reported")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+    args = parser.parse_args()
+
+    password = "benchmark"
+    with tempfile.TemporaryDirectory() as directory:
+        media_path = os.path.join(directory, "bench.boot.var")
+        make_media_file(media_path, password)
+        runs = [run_decrypt(media_path, password) for _ in range(args.rounds)]
+    elapsed, imports = min(runs, key=lambda run: run[0])
+
+    print(f"decrypt wall time: {elapsed * 1000:.1f} ms (best of {args.rounds}, importtime overhead included)")
+    print("slowest imports (cumulative):")
+    for cumulative, module in sorted(imports, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    failed = False
+    loaded = sorted({module for _, module in imports if module.split(".")[0] in FORBIDDEN_MODULES})
+    if loaded:
+        print(f"FAIL: decrypt loads the network stack: {', '.join(loaded)}")
+        failed = True
+    if elapsed * 1000 > args.budget:
+        print(f"FAIL: decrypt took longer than {args.budget:.0f} ms")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#! /usr/bin/env python3
+
+###
+##  TFTP throughput benchmark against the in-process stand-in server
+##
+##  python3 bench/bench_tftp.py --size 4194304 --latency 0.005
+###
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pxetftp
+
+VARIANTS = [
+    ("RFC 1350 (512/1)", 512, 1),
+    ("blksize 1428", 1428, 1),
+    ("blksize 1428 / window 8", 1428, 8),
+    ("blksize 1428 / window 32", 1428, 32),
+]
+
+async def run_variant(server, name, blksize, windowsize, size, rounds):
+    timings = []
+    for _ in range(rounds):
+        received = bytearray()
+        start = time.perf_counter()
+        await pxetftp.fetch(server.host, "bench.var", received.extend, port=server.port, blksize=blksize, windowsize=windowsize)
+        timings.append(time.perf_counter() - start)
+        assert len(received) == size
+    best = min(timings)
+    print(f"{name:<28} {best*1000:9.1f} ms {size/best/1024/1024:9.2f} MB/s")
+    return best
+
+async def run_parallel(server, count, size):
+    start = time.perf_counter()
+    await asyncio.gather(*(pxetftp.fetch(server.host, "bench.var", lambda block: None, port=server.port) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    print(f"{f'{count} parallel transfers':<28} {elapsed*1000:9.1f} ms {count*size/elapsed/1024/1024:9.2f} MB/s")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark pxetftp transfers against a local stand-in server")
+    parser.add_argument("--size", type=int, default=1024*1024, help="Size of the served file in bytes")
+    parser.add_argument("--latency", type=float, default=0.002, help="Delay added to every packet the server sends, in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="Share of DATA packets the server drops")
+    parser.add_argument("--rounds", type=int, default=3, help="Transfers per variant, the best one is reported")
+    parser.add_argument("--parallel", type=int, default=4, help="Number of concurrent transfers in the parallel run")
+    args = parser.parse_args()
+
+    print(f"file size {args.size} bytes, latency {args.latency*1000:.1f} ms, loss {args.loss*100:.1f}%")
+    async with pxetftp.TftpServer({"bench.var": os.urandom(args.size)}, latency=args.latency, loss=args.loss, timeout=0.2) as server:
+        for name, blksize, windowsize in VARIANTS:
+            await run_variant(server, name, blksize, windowsize, args.size, args.rounds)
+        await run_parallel(server, args.parallel, args.size)
+
+if __name__ == '__main__':
+    asyncio.run(main())
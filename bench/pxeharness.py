@@ -0,0 +1,261 @@
+#! /usr/bin/env python3
+
+###
+##  Local stand-in for a PXE enabled distribution point
+##
+##  FakeDistributionPoint answers DHCP requests on udp/4011 with a configurable option 243 (type 1 for
+##  password protected media, type 2 with the encrypted blank password key) and option 252, and
+##  pxetftp.TftpServer serves the synthetic encrypted media both options point to. Everything runs on
+##  loopback, so explore can be measured and checked on a box without a network or an SCCM site.
+##
+##  python3 bench/pxeharness.py --serve --size 1048576
+##  sudo python3 pxethiefy.py explore -a 127.0.0.1
+###
+
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Crypto.Cipher import AES
+import pxetftp
+import pxekeys
+import pxemedia
+
+BOOTP_HEADER = struct.Struct("!BBBBIHHIIII16s64s128s")
+DHCP_MAGIC_COOKIE = b"\x63\x82\x53\x63"
+DHCP_REQUEST = 3
+DHCP_ACK = 5
+
+VARIABLES_FILE = "SMSTemp\\2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var"
+EFI_VARIABLES_FILE = "SMSTemp\\2023.05.05.10.43.44.0002.{DA1A2A9C-7F8B-4D4E-9C4B-1F4E6B2C3D5A}.boot.var"
+BCD_FILE = "SMSTemp\\2023.05.05.10.43.44.0003.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.bcd"
+
+## Synthetic media
+def make_media_variables(size=0):
+    # The variables process_pxe_media_variables looks for, padded with filler variables up to about size characters
+    media_variables = {
+        "_SMSMediaGuid": "{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}",
+        "_SMSTSMediaPFX": "308209D0020103" * 16,
+        "SMSTSMP": "http://mp.lab.local",
+        "_SMSTSSiteCode": "LAB",
+        "_SMSTSx64UnknownMachineGUID": "b5e1d2a4-1b0c-4c8e-9a1e-5a1d3c2b4f60",
+    }
+    filler = 0
+    while len(media_variables_xml(media_variables)) < size:
+        media_variables[f"_SMSTSFiller{filler:06d}"] = "x" * 200
+        filler += 1
+    return media_variables
+
+def media_variables_xml(media_variables):
+    return ('<?xml version="1.0" encoding="utf-16"?><MediaVarList Version="4.00.5300.0000">'
+            + "".join(f'<var name="{name}"><![CDATA[{value}]]></var>' for name, value in media_variables.items())
+            + '</MediaVarList>')
+
+def encrypt_media_file(media_variables, password):
+    # Same layout decrypt_media_file reads: 24 header bytes, the NUL terminated UTF-16 XML in AES-128-CBC, an 8 byte trailer
+    plaintext = media_variables_xml(media_variables).encode("utf-16-le") + b"\x00\x00"
+    plaintext += b"\x00" * (-len(plaintext) % 16)
+    encrypted = AES.new(pxekeys.derive_media_key(password), AES.MODE_CBC, b"\x00"*16).encrypt(plaintext)
+    return os.urandom(pxemedia.MEDIA_FILE_DATA_OFFSET) + encrypted + os.urandom(pxemedia.MEDIA_FILE_TRAILER_SIZE)
+
+def make_encrypted_key():
+    # Encrypted key stream as found in a type 2 option 243, returns it with the password derive_blank_decryption_key makes of it
+    wrapped = AES.new(pxekeys.BLANK_PASSWORD_WRAPPING_KEY, AES.MODE_CBC, b"\x00"*16).encrypt(os.urandom(16))
+    encrypted_bytes = os.urandom(20) + wrapped + os.urandom(12)
+    encrypted_key = bytes([len(encrypted_bytes)]) + encrypted_bytes
+    return encrypted_key, bytes(pxekeys.derive_blank_decryption_key(encrypted_key))
+
+def make_option_243(variables_file, encrypted_key=None):
+    name = variables_file.encode("utf-8")
+    if encrypted_key is None:
+        return bytes([1, len(name)]) + name
+    return bytes([2, len(encrypted_key)]) + encrypted_key + bytes([1, len(name)]) + name
+
+## DHCP on the wire
+def build_dhcp_options(options):
+    packet = DHCP_MAGIC_COOKIE
+    for code, value in options:
+        packet += bytes([code, len(value)]) + value
+    return packet + b"\xff"
+
+def parse_dhcp_options(packet):
+    # {code: value} of a BOOTP packet's DHCP options, None when the magic cookie is missing
+    if packet[BOOTP_HEADER.size:BOOTP_HEADER.size + 4] != DHCP_MAGIC_COOKIE:
+        return None
+    options = {}
+    offset = BOOTP_HEADER.size + 4
+    while offset < len(packet) and packet[offset] != 255:
+        if packet[offset] == 0:
+            offset += 1
+            continue
+        length = packet[offset + 1]
+        options[packet[offset]] = packet[offset + 2:offset + 2 + length]
+        offset += 2 + length
+    return options
+
+def build_dhcp_request(xid, chaddr=b"\x00" * 6, architecture=b"\x00\x00"):
+    header = BOOTP_HEADER.pack(1, 1, 6, 0, xid, 0, 0, 0, 0, 0, 0, chaddr, b"", b"")
+    return header + build_dhcp_options([
+        (53, bytes([DHCP_REQUEST])),
+        (55, bytes([3, 1, 60, 128, 129, 130, 131, 132, 133, 134, 135])),
+        (93, architecture),
+        (250, bytes.fromhex("0c01010d020800010200070e0101050400000011ff")),
+        (60, b"PXEClient"),
+        (97, b"\x00*\x8cM\x9d\xc1lBA\x83\x87\xef\xc6\xd8s\xc6\xd2"),
+    ])
+
+def build_dhcp_reply(request, server_ip, options):
+    op, htype, hlen, _, xid, _, _, ciaddr, _, _, giaddr, chaddr, _, _ = BOOTP_HEADER.unpack_from(request)
+    server_addr = struct.unpack("!I", socket.inet_aton(server_ip))[0]
+    header = BOOTP_HEADER.pack(2, htype, hlen, 0, xid, 0, 0, ciaddr, 0, server_addr, giaddr, chaddr, b"", b"")
+    return header + build_dhcp_options([(53, bytes([DHCP_ACK])), (54, socket.inet_aton(server_ip)), (60, b"PXEClient")] + options)
+
+class FakeDistributionPoint:
+    # Answers every BOOTP request with a DHCP ACK carrying option 243 and, if set, option 252. option_243 can
+    # also map client architectures (option 93 values) to payloads; architectures it lacks get no reply.
+    # latency delays each reply, requests keeps the xid of every request seen.
+    def __init__(self, option_243, bcd_file=None, host="127.0.0.1", port=4011, latency=0.0):
+        self.option_243 = option_243
+        self.bcd_file = bcd_file
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.requests = []
+        self._transport = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        server = self
+
+        class ListenProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                server._on_request(data, addr)
+
+        self._transport, _ = await loop.create_datagram_endpoint(ListenProtocol, local_addr=(self.host, self.port), family=socket.AF_INET)
+        self.host, self.port = self._transport.get_extra_info("sockname")[:2]
+        return self.host, self.port
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _on_request(self, data, addr):
+        request_options = parse_dhcp_options(data) if len(data) >= BOOTP_HEADER.size and data[0] == 1 else None
+        if request_options is None:
+            return
+        self.requests.append(BOOTP_HEADER.unpack_from(data)[4])
+        option_243 = self.option_243
+        if isinstance(option_243, dict):
+            option_243 = option_243.get(request_options.get(93, b"\x00\x00"))
+            if option_243 is None:
+                return
+        options = [(243, option_243)]
+        if self.bcd_file:
+            options.append((252, self.bcd_file.encode("utf-8") + b"\x00"))
+        reply = build_dhcp_reply(data, self.host, options)
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self._transport.sendto, reply, addr)
+        else:
+            self._transport.sendto(reply, addr)
+
+def socket_request(host, port=4011, xid=None, timeout=2.0):
+    # Pure-socket counterpart of request_boot_files_from_ip: one request from an ephemeral port, returns the DHCP options
+    xid = xid if xid is not None else struct.unpack("!I", os.urandom(4))[0]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(timeout)
+        client.sendto(build_dhcp_request(xid), (host, port))
+        deadline = time.monotonic() + timeout
+        while True:
+            client.settimeout(max(deadline - time.monotonic(), 0.001))
+            reply, _ = client.recvfrom(4096)
+            if reply[0] == 2 and BOOTP_HEADER.unpack_from(reply)[4] == xid:
+                return parse_dhcp_options(reply)
+
+class DistributionPointHarness:
+    # Runs a FakeDistributionPoint and a pxetftp.TftpServer with synthetic media on a background event loop.
+    # With blank set the media is encrypted with a blank password key (type 2 option 243), otherwise with password.
+    # With efi_media set, x86 and x64 EFI clients are offered a second media file (efi_media) instead.
+    def __init__(self, media_size=0, blank=True, password="Summer2023!", host="127.0.0.1", dhcp_port=4011, tftp_port=0,
+                 latency=0.0, bcd=True, efi_media=False):
+        self.host = host
+        self.media_variables = make_media_variables(media_size)
+        self.encrypted_key = None
+        self.password = password
+        if blank:
+            self.encrypted_key, self.password = make_encrypted_key()
+        self.media = encrypt_media_file(self.media_variables, self.password)
+        self.bcd_file = BCD_FILE if bcd else None
+        files = {VARIABLES_FILE: self.media}
+        if bcd:
+            files[BCD_FILE] = os.urandom(16 * 1024)
+        option_243 = make_option_243(VARIABLES_FILE, self.encrypted_key)
+        self.efi_media = None
+        if efi_media:
+            self.efi_media = encrypt_media_file(self.media_variables, self.password)
+            files[EFI_VARIABLES_FILE] = self.efi_media
+            efi_option_243 = make_option_243(EFI_VARIABLES_FILE, self.encrypted_key)
+            option_243 = {b"\x00\x00": option_243, b"\x00\x06": efi_option_243, b"\x00\x07": efi_option_243}
+        self.dp = FakeDistributionPoint(option_243, self.bcd_file, host, dhcp_port, latency)
+        self.tftp = pxetftp.TftpServer(files, host, tftp_port, latency=latency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def variables_file(self):
+        return VARIABLES_FILE
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.dp.start(), self._loop).result()
+        asyncio.run_coroutine_threadsafe(self.tftp.start(), self._loop).result()
+        return self
+
+    def close(self):
+        async def shutdown():
+            self.dp.close()
+            await self.tftp.__aexit__(None, None, None)
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic PXE media from a stand-in distribution point")
+    parser.add_argument("--serve", action="store_true", help="Run until interrupted")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Approximate size of the media variables in characters")
+    parser.add_argument("--password", default=None, help="Encrypt the media with this password instead of a blank password key")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay added to every reply, in seconds")
+    parser.add_argument("--efi-media", action="store_true", help="Offer different media to EFI clients")
+    args = parser.parse_args()
+
+    with DistributionPointHarness(args.size, blank=args.password is None, password=args.password, host=args.host,
+                                  tftp_port=69, latency=args.latency, efi_media=args.efi_media) as harness:
+        print(f"DHCP/PXE on {harness.dp.host}:{harness.dp.port}, TFTP on {harness.tftp.host}:{harness.tftp.port}")
+        print(f"variables file {harness.variables_file} ({len(harness.media)} bytes), password {harness.password!r}")
+        options = socket_request(harness.dp.host, harness.dp.port)
+        print(f"self-test: option 243 {options[243].hex()}")
+        while args.serve:
+            time.sleep(3600)
+
+if __name__ == '__main__':
+    main()
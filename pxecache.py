@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+
+###
+##  Persistent result cache for pxethiefy.py
+##
+##  Entries are keyed by distribution point, variables file name and the SHA-256 of the
+##  media file. They keep the option 243 payload, the keys derived for the media and the
+##  parsed variables, so repeated explore runs and decrypt calls on a file that was already
+##  processed can skip the network and the crypto. Entries expire after ttl seconds and the
+##  least recently used ones are dropped beyond max_entries.
+###
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+HASH_READ_SIZE = 1024 * 1024
+# Bumped whenever SCHEMA changes
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    dp TEXT NOT NULL,
+    variables_file TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    option_243 BLOB,
+    bcd_file TEXT,
+    blank_key BLOB,
+    media_key BLOB,
+    header BLOB,
+    variables TEXT,
+    complete INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    architectures TEXT,
+    media_file TEXT,
+    PRIMARY KEY (dp, variables_file, content_hash)
+);
+CREATE INDEX IF NOT EXISTS media_content_hash ON media (content_hash);
+"""
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "pxethiefy", "cache.sqlite3")
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as media_file:
+        for chunk in iter(lambda: media_file.read(HASH_READ_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class ResultCache:
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path or default_cache_path()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        directory = os.path.dirname(self.path)
+        # The cache holds media keys and the parsed variables (including _SMSTSMediaPFX), keep it private
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+        os.chmod(self.path, 0o600)
+        # One connection shared by the explore worker threads, serialized by the lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            # A cache written with another schema is dropped rather than migrated, its entries are fetched again
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS media")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.executescript(SCHEMA)
+        self.evict()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _entry(self, row):
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["variables"] = json.loads(entry["variables"]) if entry["variables"] else None
+        entry["complete"] = bool(entry["complete"])
+        # decrypt stores entries without architectures, they count as BIOS like in lookup_dp
+        entry["architectures"] = entry["architectures"].split(",") if entry["architectures"] else ["bios"]
+        with self._db:
+            self._db.execute("UPDATE media SET accessed = ? WHERE dp = ? AND variables_file = ? AND content_hash = ?",
+                             (time.time(), entry["dp"], entry["variables_file"], entry["content_hash"]))
+        return entry
+
+    def lookup_dp(self, dp, architecture="bios"):
+        # Most recent media this distribution point offered to the given client architecture
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM media WHERE dp = ? AND created >= ? ORDER BY created DESC",
+                                    (dp, time.time() - self.ttl)).fetchall()
+            row = next((row for row in rows if architecture in (row["architectures"] or "bios").split(",")), None)
+            return self._entry(row)
+
+    def lookup_content(self, content_hash):
+        # Any entry for a media file with this content, preferring the ones with parsed variables
+        with self._lock:
+            row = self._db.execute("SELECT * FROM media WHERE content_hash = ? AND created >= ? ORDER BY variables IS NULL, complete DESC, created DESC LIMIT 1",
+                                   (content_hash, time.time() - self.ttl)).fetchone()
+            return self._entry(row)
+
+    def store(self, dp, variables_file, content_hash, option_243=None, bcd_file=None, blank_key=None, media_key=None,
+              header=None, variables=None, complete=False, architectures=None, media_file=None):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (dp or "", variables_file or "", content_hash,
+                              bytes(option_243) if option_243 else None, bcd_file,
+                              bytes(blank_key) if blank_key else None, bytes(media_key) if media_key else None,
+                              bytes(header) if header else None, json.dumps(variables) if variables is not None else None,
+                              int(complete), now, now, ",".join(architectures) if architectures else None, media_file))
+        self.evict()
+
+    def evict(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM media WHERE created < ?", (time.time() - self.ttl,))
+            self._db.execute("DELETE FROM media WHERE rowid NOT IN (SELECT rowid FROM media ORDER BY accessed DESC LIMIT ?)",
+                             (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM media")
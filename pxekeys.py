@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+
+###
+##  Key derivation for SCCM media variables files
+##
+##  Same results as the original PXEThief implementation (CryptDeriveKey with SHA1), but the
+##  ipad/opad XOR is done with precomputed bytes.translate tables instead of per-byte
+##  concatenation, and derive_media_keys() handles a whole batch of passwords in one call.
+##  Credits to MWR-CyberSec
+##  https://github.com/MWR-CyberSec/PXEThief/blob/main/media_variable_file_cryptography.py
+###
+
+from hashlib import sha1
+from Crypto.Cipher import AES
+
+IPAD = bytes(x ^ 0x36 for x in range(256))
+OPAD = bytes(x ^ 0x5c for x in range(256))
+IPAD_PADDING = b"\x36" * (64 - 20)     # SHA1 digests are 20 bytes, padded to the 64 byte block
+OPAD_PADDING = b"\x5c" * (64 - 20)
+SIGN_EXTEND = bytes(0xFF if x & 0x80 else 0x00 for x in range(256))
+
+BLANK_PASSWORD_KEY_DATA = b'\x9F\x67\x9C\x9B\x37\x3A\x1F\x48\x82\x4F\x37\x87\x33\xDE\x24\xE9' #Harcoded in tspxe.dll
+
+def aes_des_key_derivation(password):
+    key_sha1 = sha1(password).digest()
+    return sha1(key_sha1.translate(IPAD) + IPAD_PADDING).digest() + sha1(key_sha1.translate(OPAD) + OPAD_PADDING).digest()
+
+def encode_password(password):
+    # Passwords typed by the user are UTF-16 strings, keys recovered from option 243 are raw bytes
+    if type(password) == str:
+        return password.encode("utf-16-le")
+    return bytes(password)
+
+def derive_media_key(password):
+    # AES-128 only uses the first 16 bytes of the derived key, which all come from the ipad half
+    return sha1(sha1(encode_password(password)).digest().translate(IPAD) + IPAD_PADDING).digest()[:16]
+
+def derive_media_keys(passwords):
+    # Batch version of derive_media_key, returns one 16 byte key per password in order
+    _sha1, _ipad, _padding, _encode = sha1, IPAD, IPAD_PADDING, encode_password
+    return [_sha1(_sha1(_encode(password)).digest().translate(_ipad) + _padding).digest()[:16] for password in passwords]
+
+BLANK_PASSWORD_WRAPPING_KEY = aes_des_key_derivation(BLANK_PASSWORD_KEY_DATA)[:16]
+
+def derive_blank_decryption_key(encrypted_key):
+    length = encrypted_key[0]
+    encrypted_bytes = encrypted_key[1:1+length] # pull out 48 bytes that relate to the encrypted bytes in the DHCP response
+    encrypted_bytes = encrypted_bytes[20:-12] # isolate encrypted data bytes
+    var_file_key = AES.new(BLANK_PASSWORD_WRAPPING_KEY, AES.MODE_CBC, b"\x00"*16).decrypt(encrypted_bytes[:16])[:10]
+    # Every key byte is followed by 0xFF if its leading bit is set, 0x00 otherwise
+    new_key = bytearray(20)
+    new_key[0::2] = var_file_key
+    new_key[1::2] = var_file_key.translate(SIGN_EXTEND)
+    return new_key
@@ -0,0 +1,46 @@
+#! /usr/bin/env python3
+
+###
+##  Console logging shared by the pxethiefy.py modules
+##
+##  gLogStream is switched to stderr by pxethiefy.py when JSON results go to stdout.
+###
+
+import sys
+import threading
+
+__all__ = ["MSG_TYPE_NOCOLOR", "MSG_TYPE_NOPREFIX", "MSG_TYPE_DEFAULT", "MSG_TYPE_SUCCESS", "MSG_TYPE_WARNING",
+           "MSG_TYPE_INFO", "MSG_TYPE_ERROR", "MSG_TYPE_END", "log"]
+
+gLogStream = sys.stdout
+
+MSG_TYPE_NOCOLOR = ""
+MSG_TYPE_NOPREFIX = ""
+MSG_TYPE_DEFAULT = "\033[1m"
+MSG_TYPE_SUCCESS = "\033[32m"
+MSG_TYPE_WARNING = "\033[93m"
+MSG_TYPE_INFO = "\033[96m"
+MSG_TYPE_ERROR = "\033[91m"
+MSG_TYPE_END = "\033[0m"
+
+gLogLock = threading.Lock()
+
+def log(msg, msgType=MSG_TYPE_DEFAULT):
+    prefix = "[*] "
+    if( msgType == MSG_TYPE_NOPREFIX ):
+        prefix = ""
+    else:
+        if( msgType == MSG_TYPE_SUCCESS or msgType == MSG_TYPE_INFO):
+            prefix = "[+] "
+        elif( msgType == MSG_TYPE_WARNING ):
+            prefix = "[!] "
+        elif( msgType == MSG_TYPE_ERROR ):
+            prefix = "[-] "
+    
+    with gLogLock:
+        print("%s%s%s%s" %(
+            msgType,
+            prefix,
+            msg,
+            MSG_TYPE_END  
+        ), file=gLogStream)
